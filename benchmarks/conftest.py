@@ -0,0 +1,75 @@
+"""Shared fixtures for the benchmarks, see the Makefile's benchmark targets."""
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+
+# Modules in src/ import each other by bare name
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from alerts import Alerts  # noqa: E402
+from c import async_redis_handles, get_settings  # noqa: E402
+from persistence import SignalHistory  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def redis_server():
+    """In-process fakeredis server standing in for Redis."""
+    from fakeredis import TcpFakeServer
+    server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    os.environ.update(REDIS_HOST=host, REDIS_PORT=str(port))
+    os.environ.pop('SIGNAL_ARCHIVE_DIR', None)
+    get_settings.cache_clear()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    handle = async_redis_handles.pop(loop, None)
+    if handle is not None and handle.done() and not handle.exception():
+        r = handle.result()
+        r.close()
+        loop.run_until_complete(r.wait_closed())
+    loop.close()
+
+
+async def call(func, *args):
+    return await func(*args)
+
+
+@pytest.fixture
+def run(loop):
+    """Run func(*args) to completion on the loop, aioredis commands need to
+    be called from inside it."""
+    return lambda func, *args: loop.run_until_complete(call(func, *args))
+
+
+@pytest.fixture
+def r(redis_server, run):
+    from c import async_redis_handle
+    r = run(async_redis_handle)
+    run(r.flushall)
+    return r
+
+
+@pytest.fixture(autouse=True)
+def signal_state():
+    """Start every benchmark with no signal stores, samplers or flush cursors."""
+    alerts = Alerts()
+    alerts.data.clear()
+    alerts.samplers.clear()
+    SignalHistory().cursors.clear()
+    yield
+    alerts.data.clear()
+    alerts.samplers.clear()
+    SignalHistory().cursors.clear()
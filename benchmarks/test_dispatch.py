@@ -0,0 +1,78 @@
+"""Dispatching a burst of messages with Matrix sends stubbed out."""
+import asyncio
+import argparse
+import functools
+
+import pytest
+
+from log import Dispatcher
+
+MESSAGES = 500
+ROOMS = 10
+
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    dispatcher = Dispatcher()
+    sends = []
+
+    async def send_digest(args, body):
+        await asyncio.sleep(0)
+        sends.append(args.room)
+
+    monkeypatch.setattr(dispatcher, 'send_digest', send_digest)
+    monkeypatch.setattr(dispatcher, 'digest_window', 0)
+    monkeypatch.setattr(dispatcher, 'rate', 1e9)
+    monkeypatch.setattr(dispatcher, 'burst', 1e9)
+    dispatcher.rooms.clear()
+    yield dispatcher, sends
+    dispatcher.rooms.clear()
+
+
+async def dispatch(dispatcher, rooms):
+    await asyncio.gather(*(
+        dispatcher.send(rooms[i % ROOMS], f'message {i}') for i in range(MESSAGES)
+    ))
+
+
+def test_dispatch_burst(benchmark, run, dispatcher):
+    dispatcher, sends = dispatcher
+    rooms = [
+        argparse.Namespace(host='host', user='user', password=None, room=f'room_{i}')
+        for i in range(ROOMS)
+    ]
+    benchmark.pedantic(run, args=(dispatch, dispatcher, rooms), setup=sends.clear, rounds=5, warmup_rounds=1)
+    # Messages queued while a room's send is in flight go out as one digest
+    assert len(sends) < MESSAGES
+
+
+def test_alerts_fired_in_one_tick_share_a_digest(run, r, dispatcher, loop):
+    """Every alert fired on a tick is queued before any is sent, so one room gets one digest."""
+    from alerts import (
+        Alert, AlertTask, MatrixConfig, SignalSampler, send_to_matrix_room,
+    )
+    import numpy as np
+
+    dispatcher, sends = dispatcher
+    dispatcher.digest_window = 0.1
+    sampler = SignalSampler(loop, 'benchmark')
+    action = functools.partial(
+        send_to_matrix_room, matrix_config=MatrixConfig(host='host', user='user', password='password'),
+    )
+    for difference in range(5):
+        alert = Alert(
+            condition={'signal': 'benchmark', 'timeframe': {'hours': 1}, 'difference': difference},
+            message=f'moved {difference}%', room='room',
+        )
+        sampler.subscribe(AlertTask(loop=loop, alert=alert, signal=None, alert_action=action), None)
+    store = AlertTask.signal_store('benchmark')
+    store.append(100.0)
+    store.append(110.0)
+
+    async def tick():
+        await sampler.evaluate(store, 0, np.ones(len(sampler.subscribers), dtype=bool))
+        assert sampler.notifying  # evaluate returned without waiting on delivery
+        await asyncio.wait(list(sampler.notifying))
+
+    run(tick)
+    assert sends == ['room']
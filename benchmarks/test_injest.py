@@ -0,0 +1,42 @@
+"""Appending a reading to a signal and reading an alert's window of it."""
+import numpy as np
+import pytest
+
+from alerts import Alert, AlertTask, SignalStrategy
+from evaluate import evaluate_batch
+from store import now_ns
+
+HISTORY_SIZES = [100, 10000, 1000000]
+
+
+def alert_task(strategy):
+    alert = Alert(
+        condition={'signal': 'benchmark', 'timeframe': {'hours': 1}, 'difference': 5},
+        message='{{ last }}',
+        poll_rate=1,
+        signal_read_strategy=strategy,
+    )
+    return AlertTask(loop=None, alert=alert, signal=None, alert_action=None)
+
+
+@pytest.mark.parametrize('size', HISTORY_SIZES)
+@pytest.mark.parametrize('strategy', list(SignalStrategy), ids=lambda s: s.value)
+def test_injest_reading(benchmark, strategy, size):
+    task = alert_task(strategy)
+    store = AlertTask.signal_store(task.signal_name)
+    # size readings spread over the last half of the alert's timeframe
+    now = now_ns()
+    store.extend(
+        np.random.default_rng(0).random(size) + 100,
+        np.linspace(now - 1800 * 10 ** 9, now, size, dtype=np.int64),
+    )
+    windows = np.array([task.compiled.window], dtype=np.int64)
+    min_max = np.array([task.compiled.min_max])
+    thresholds = np.array([task.compiled.threshold])
+    values = iter(np.random.default_rng(1).random(10 ** 7) + 100)
+
+    def injest():
+        AlertTask.injest_reading(task.signal_name, next(values))
+        return evaluate_batch(store, windows, min_max, thresholds)
+
+    benchmark(injest)
@@ -0,0 +1,68 @@
+"""Draining the message queue with Matrix sends stubbed out."""
+import asyncio
+
+import pytest
+
+import message_queue
+from message_queue import (
+    MessageDelivery, MessageInjest, dequeue_messages, get_settings,
+    processing_queue,
+)
+
+MESSAGES = 500
+ROOMS = 10
+BLOCK_TIMEOUT = 1
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    monkeypatch.setenv('MATRIX_USER', 'benchmark')
+    monkeypatch.setenv('MATRIX_HOST', 'http://localhost')
+    monkeypatch.setenv('MATRIX_PASSWORD', 'benchmark')
+    monkeypatch.setenv('BLOCK_TIMEOUT', str(BLOCK_TIMEOUT))
+    get_settings.cache_clear()
+    yield monkeypatch
+    get_settings.cache_clear()
+
+
+async def consume(monkeypatch, r, processing, delivered):
+    """Run the consumer until every message was sent and acknowledged."""
+    done = asyncio.Event()
+
+    async def sent(delivery):
+        delivered.append(delivery)
+        if len(delivered) == MESSAGES:
+            done.set()
+        return delivery
+
+    monkeypatch.setattr(message_queue, 'send_message', sent)
+    consumer = asyncio.ensure_future(dequeue_messages())
+    await done.wait()
+    while await r.llen(processing):
+        await asyncio.sleep(0)
+    consumer.cancel()
+    await asyncio.gather(consumer, return_exceptions=True)
+
+
+@pytest.mark.parametrize('batch_size', [1, 100])
+def test_dequeue_messages(benchmark, monkeypatch, run, r, settings, batch_size):
+    settings.setenv('BATCH_SIZE', str(batch_size))
+    processing = processing_queue()
+    messages = [
+        MessageDelivery(message=MessageInjest(room=f'room_{i % ROOMS}', message=f'message {i}')).json()
+        for i in range(MESSAGES)
+    ]
+    delivered = []
+
+    def setup():
+        # Let the cancelled consumer's blocking pop time out so it can't take a message
+        run(asyncio.sleep, BLOCK_TIMEOUT + 0.1)
+        delivered.clear()
+        run(r.lpush, 'injest', *messages)
+
+    benchmark.pedantic(run, args=(consume, monkeypatch, r, processing, delivered), setup=setup, rounds=5)
+    assert sorted(d.message.message for d in delivered) == sorted(
+        MessageDelivery.parse_raw(m).message.message for m in messages
+    )
+    assert run(r.llen, 'injest') == 0
+    assert run(r.llen, processing) == 0
@@ -0,0 +1,58 @@
+"""Saving and loading the signal database against a fakeredis server."""
+import numpy as np
+import pytest
+
+from alerts import Alerts, AlertTask, load_signal_database, save_signal_database
+from persistence import SignalHistory
+from store import now_ns
+
+SIGNALS = 10
+
+
+def populate(readings):
+    now = now_ns()
+    for i in range(SIGNALS):
+        AlertTask.injest_readings(
+            f'benchmark_{i}',
+            np.random.default_rng(i).random(readings),
+            np.linspace(now - 3600 * 10 ** 9, now, readings, dtype=np.int64),
+        )
+    return snapshot()
+
+
+def snapshot():
+    return {
+        signal: (store.timestamps.copy(), store.values.copy())
+        for signal, store in Alerts().data.items()
+    }
+
+
+def assert_snapshot(expected):
+    loaded = snapshot()
+    assert loaded.keys() == expected.keys()
+    for signal, (timestamps, values) in expected.items():
+        np.testing.assert_array_equal(loaded[signal][0], timestamps)
+        np.testing.assert_array_equal(loaded[signal][1], values)
+
+
+@pytest.mark.parametrize('readings', [100, 1000])
+def test_save_signal_database(benchmark, run, r, readings):
+    saved = populate(readings)
+
+    def setup():
+        # Nothing flushed yet so every round writes all the readings
+        SignalHistory().cursors.clear()
+        run(r.flushall)
+
+    benchmark.pedantic(run, args=(save_signal_database,), setup=setup, rounds=10)
+    Alerts().data.clear()
+    run(load_signal_database)
+    assert_snapshot(saved)
+
+
+@pytest.mark.parametrize('readings', [100, 1000])
+def test_load_signal_database(benchmark, run, r, readings):
+    saved = populate(readings)
+    run(save_signal_database)
+    benchmark.pedantic(run, args=(load_signal_database,), rounds=10)
+    assert_snapshot(saved)
@@ -0,0 +1,11 @@
+"""Rendering an alert's message from its reading."""
+from alerts import Alert, AlertTask, render_message
+
+
+def test_render_message(benchmark):
+    alert = Alert(
+        condition={'signal': 'btc_price', 'timeframe': {'hours': 4}, 'difference': 2},
+        room='btc_price_alerts',
+        message='BTC Price ({{ last }}) moved {{ direction }} {{ diff }}% in the last 4 hours ({{ first }}).',
+    )
+    benchmark(render_message, alert, AlertTask.signal_reading(7179.4, 6935.59))
@@ -0,0 +1,46 @@
+"""SignalReading as a NamedTuple against the pydantic model it replaced."""
+import tracemalloc
+
+import pydantic
+import pytest
+
+from alerts import SignalReading
+from util import get_deviation_percentage
+
+
+class PydanticSignalReading(pydantic.BaseModel):
+    first: float
+    last: float
+    increased: bool
+    diff: float
+
+
+def evaluation(cls):
+    """Build a reading as an evaluation does and convert it as render_message does."""
+    def evaluate(first=7179.4, last=6935.59):
+        reading = cls(
+            first=float(first),
+            last=float(last),
+            increased=float(first)<float(last),
+            diff=float(get_deviation_percentage(first, last)),
+        )
+        return reading, dict(reading._asdict() if cls is SignalReading else reading)
+    return evaluate
+
+
+def allocated(func, n=10000):
+    """Bytes still held per call after n calls."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        held = [func() for _ in range(n)]
+        return (tracemalloc.get_traced_memory()[0] - before) // len(held)
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize('cls', [SignalReading, PydanticSignalReading], ids=['namedtuple', 'pydantic'])
+def test_signal_reading(benchmark, cls):
+    evaluate = evaluation(cls)
+    benchmark.extra_info['bytes_per_evaluation'] = allocated(evaluate)
+    benchmark(evaluate)
@@ -0,0 +1,29 @@
+"""CLI startup, commands that don't evaluate signals shouldn't load numpy."""
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(__file__), '..', 'src')
+
+LIST_SIGNALS = """
+import runpy, sys
+sys.argv = ['alerts.py', 'list-signals']
+try:
+    runpy.run_path('alerts.py', run_name='__main__')
+except SystemExit:
+    pass
+print('numpy' in sys.modules, file=sys.stderr)
+"""
+
+
+def list_signals():
+    return subprocess.run(
+        [sys.executable, '-c', LIST_SIGNALS],
+        cwd=SRC, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    )
+
+
+def test_list_signals_does_not_import_numpy(benchmark):
+    result = benchmark.pedantic(list_signals, rounds=3)
+    assert 'server_load_1m' in result.stdout.decode()
+    assert result.stderr.decode().strip().splitlines()[-1] == 'False'
@@ -0,0 +1,38 @@
+"""Running alerts sharded across worker processes through the CLI."""
+import os
+import signal
+import subprocess
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(__file__), '..', 'src')
+
+ALERTS = """
+- condition:
+    signal: server_load_1m
+    timeframe:
+      minutes: 5
+    difference: 0
+  poll_rate: 1
+  message: load {{ last }}
+"""
+
+
+def test_file_with_workers(tmp_path, r):
+    alerts = tmp_path / 'alerts.yaml'
+    alerts.write_text(ALERTS)
+    out = tmp_path / 'out.txt'
+    process = subprocess.Popen(
+        [sys.executable, 'alerts.py', 'file', '-f', str(alerts), '-o', str(out), '--workers', '2'],
+        cwd=SRC, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    try:
+        deadline = time.monotonic() + 30
+        while not (out.exists() and out.read_text()) and process.poll() is None:
+            assert time.monotonic() < deadline, 'no alert was written'
+            time.sleep(0.1)
+        assert process.poll() is None, process.stderr.read().decode()
+        assert out.read_text().startswith('load ')
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=10)
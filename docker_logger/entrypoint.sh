@@ -1,2 +1,2 @@
 env 2>&1 > /app/env
-cron -f
+exec bash /app/docker_logger/scripts/docker_logs_to_matrix.sh
@@ -1,14 +1,48 @@
-while read LINE; do export "$LINE"; done < /app/env
+#!/bin/bash
+# Ships the logs of every docker service to its docker_<service> room from a
+# single long running log.py. When services are added or removed log.py is
+# restarted, it resumes each service's logs from where it left off.
 
-sleep $((RANDOM/1000))
-
-for service in $(\
-  docker service ls \
-    | awk '{print $2}'\
-    | grep -vE '^NAME$'\
+function services {
+  docker service ls --format '{{.Name}}'\
     | grep -vi synapse\
-)
+    | sort
+}
+
+function ship {
+  pid=
+  tails=()
+  for service in $1
+  do
+    tails+=(--tail "docker_$service=!docker service logs --follow --timestamps --since {since} $service")
+  done
+  if [ ${#tails[@]} -gt 0 ]
+  then
+    python3 /app/src/log.py --host "$MATRIX_HOST" --user "$MATRIX_USER" "${tails[@]}" &
+    pid=$!
+  fi
+}
+
+function stop {
+  if [ -n "$pid" ]
+  then
+    kill -TERM "$pid" 2>/dev/null
+    wait "$pid"
+  fi
+}
+
+trap 'stop; kill $(jobs -p) 2>/dev/null; exit 0' TERM INT
+
+current=$(services)
+ship "$current"
+while true
 do
-  docker service logs --since 1m "$service"\
-    | python3 /app/src/log.py --host "$MATRIX_HOST" --user "$MATRIX_USER" --room docker_$service
+  sleep 60 & wait $!
+  latest=$(services)
+  if [ "$latest" != "$current" ] || ! kill -0 "$pid" 2>/dev/null
+  then
+    stop
+    current=$latest
+    ship "$current"
+  fi
 done
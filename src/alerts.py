@@ -1,26 +1,43 @@
-import atexit
 import asyncio
 import argparse
 from datetime import datetime, timedelta
 import enum
 import functools
 import hashlib
+import logging
 import os
+from signal import SIGTERM
 import sys
-from typing import Any, List, Optional
+import time
+from typing import Any, List, NamedTuple, Optional
 
 import click
-import jinja2
-import pandas as pd
-from pandas import DataFrame, Timestamp, Timedelta
-import pyarrow as pa
 from model import BaseModel
 import yaml
 
 
-from log import enqueue as send_matrix_message, logger
-from signals import SignalMap, EOF
-from util import Borg, get_deviation_percentage, schedule_func, redis_handle
+from log import Dispatcher, Priority, enqueue, format_message, logger, sampled, trace
+from signals import SignalMap
+from c import get_settings
+from cooldown import CooldownRegistry
+from fetch import close_fetcher
+import metrics
+from metrics import Counter, Histogram
+from workers import Supervisor, shard_for
+from util import Borg, async_redis_handle, cancel_tasks, get_deviation_percentage, schedule_func
+
+SIGNAL_FETCH = Histogram('signal_fetch_seconds', 'Time polling a signal', ['signal'])
+SIGNAL_FETCH_ERRORS = Counter('signal_fetch_errors_total', 'Failed signal polls', ['signal'])
+SIGNAL_INJEST = Histogram('signal_injest_seconds', 'Time appending readings to a signal', ['signal'])
+SIGNAL_READINGS = Counter('signal_readings_total', 'Readings appended to a signal', ['signal'])
+ALERT_EVALUATION = Histogram(
+    'alert_evaluation_seconds', 'Time evaluating every alert on a signal in one batch', ['signal'],
+)
+ALERTS_EVALUATED = Counter('alerts_evaluated_total', 'Alert evaluations', ['signal'])
+ALERTS_FIRED = Counter('alerts_fired_total', 'Alerts past their threshold', ['signal'])
+ALERTS_COOLING = Counter('alerts_cooling_total', 'Fired alerts skipped during their cooloff', ['signal'])
+ALERT_ACTION = Histogram('alert_action_seconds', 'Time running alert actions', ['action'])
+ALERT_ACTION_ERRORS = Counter('alert_action_errors_total', 'Alert actions that raised', ['action'])
 
 class MatrixConfig(BaseModel):
     host: str
@@ -31,12 +48,32 @@ class MatrixConfig(BaseModel):
 class MatrixLog(MatrixConfig):
     message: str
     room: str
+    priority: Priority = Priority.normal
+
+
+@functools.lru_cache()
+def get_template_environment():
+    import jinja2
+    return jinja2.Environment()
+
+
+@functools.lru_cache(maxsize=1024)
+def get_template(message):
+    """Compiled template for an alert message, shared by alerts with the same message."""
+    return get_template_environment().from_string(message)
+
+
+def prime_templates(alerts):
+    for alert in alerts:
+        get_template(alert.message)
+    return alerts
 
 
 def render_message(alert, signal_reading):
-    return jinja2.Template(alert.message).render(
-        **alert.dict(),
-        **signal_reading.dict(),
+    # dict(model) is shallow, unlike model.dict() nothing is copied or converted
+    return get_template(alert.message).render(
+        **dict(alert),
+        **signal_reading._asdict(),
         direction='up' if signal_reading.increased else 'down',
     )
 
@@ -52,12 +89,15 @@ async def send_to_stdout(alert, signal_reading):
 
 async def send_to_matrix_room(alert, signal_reading, matrix_config):
     message = render_message(alert, signal_reading)
-    logger.debug(f"Sending {alert} message {message}")
-    matrix_log = {**matrix_config.dict(), 'message': message, 'room': alert.room}
-    ret = await send_matrix_message(
-        MatrixLog(**matrix_log)
+    logger.debug("Sending %s message %s", alert, message)
+    matrix_log = MatrixLog(
+        **matrix_config.dict(), message=message, room=alert.room, priority=alert.priority,
     )
-    logger.debug(f"Alert finished {ret}")
+    if os.getenv('MESSAGE_QUEUE'):
+        ret = await enqueue(matrix_log)
+    else:
+        ret = await Dispatcher().send(matrix_log, format_message(message), alert.priority)
+    logger.debug("Alert finished %s", ret)
 
 
 class DeviationCondition(BaseModel):
@@ -66,12 +106,16 @@ class DeviationCondition(BaseModel):
     difference: int
 
 
-class SignalReading(BaseModel):
+class SignalReading(NamedTuple):
+    """A fired alert's reading, plain tuple as one is built every evaluation."""
     first: float
     last: float
     increased: bool
     diff: float
 
+    def dict(self):
+        return self._asdict()
+
     def __str__(self):
         return f"<SignalReading first={round(self.first, 3)}, last={round(self.last, 3)}, diff={round(self.diff, 3)}, increased={self.increased}>"
 
@@ -81,18 +125,17 @@ class SignalStrategy(enum.Enum):
     min_max = 'min_max'
 
 
-def signal_strategy_oldest_newest(df):
-    return (
-        float(df.sort_index(ascending=False).tail(1).iloc[0]),
-        float(df.sort_index(ascending=False).head(1).iloc[0]),
-    )
-
-
-def signal_strategy_min_max(df):
-    return (
-        df['value'].min(),
-        df['value'].max(),
-    )
+class CompiledAlert(NamedTuple):
+    """What evaluating an Alert needs, computed once instead of every tick."""
+    id: str
+    signal: str
+    timeframe: timedelta
+    window: int  # timeframe in ns
+    threshold: float
+    cooloff_ms: int
+    poll_rate: int
+    min_max: bool  # read with the min_max strategy instead of oldest_newest
+    traced: bool  # whether evaluations of the alert are traced
 
 
 class Alert(BaseModel):
@@ -103,18 +146,23 @@ class Alert(BaseModel):
     cooloff: Optional[timedelta]
     poll_rate: int = 60
     signal_read_strategy: SignalStrategy = SignalStrategy.oldest_newest
+    priority: Priority = Priority.normal  # critical messages skip digests and queued messages
 
     @property
     def id(self):
-        return hashlib.sha256(repr(self.dict()).encode('utf-8')).hexdigest()
+        # last_notified is state and priority only how it's delivered,
+        # neither is part of the alert's identity
+        return hashlib.sha256(
+            repr(self.dict(exclude={'last_notified', 'priority'})).encode('utf-8'),
+        ).hexdigest()
 
     @property
-    def timeframe(self):
-        return timedelta(**self.condition.timeframe)
+    def cooloff_ms(self):
+        return int((self.cooloff or self.timeframe).total_seconds() * 1000)
 
     @property
-    def timeframe_pd(self):
-        return Timedelta(**self.condition.timeframe)
+    def timeframe(self):
+        return timedelta(**self.condition.timeframe)
 
     @classmethod
     def load_collection(cls, file):
@@ -125,18 +173,28 @@ class Alert(BaseModel):
             alerts.append(
                 cls(condition=DeviationCondition(**alert.pop('condition')), **alert)
             )
-        return alerts
+        return prime_templates(alerts)
 
     def __str__(self):
         return f'Alert<{self.condition.signal} {self.condition.difference}% in {self.timeframe}>'
 
-    @property
-    def signal_read_strategy_func(self):
-        m = {
-            SignalStrategy.oldest_newest: signal_strategy_oldest_newest,
-            SignalStrategy.min_max: signal_strategy_min_max,
-        }
-        return m[self.signal_read_strategy]
+    def compile(self):
+        from store import timedelta_ns
+        settings = get_settings()
+        timeframe = self.timeframe
+        alert_id = self.id
+        return CompiledAlert(
+            id=alert_id,
+            signal=self.condition.signal.lower(),
+            timeframe=timeframe,
+            window=timedelta_ns(timeframe),
+            threshold=float(self.condition.difference),
+            cooloff_ms=self.cooloff_ms,
+            poll_rate=self.poll_rate,
+            min_max=self.signal_read_strategy == SignalStrategy.min_max,
+            traced=alert_id in settings.trace_alerts
+                or sampled(alert_id, settings.trace_sample_rate),
+        )
 
 
 class Alerts:
@@ -152,26 +210,90 @@ class Alerts:
             self.api
         except AttributeError:
             self.api = {}
+        try:
+            self.samplers
+        except AttributeError:
+            self.samplers = {}
 
 
-def get_signals(signals=None):
-    r = redis_handle()
+async def get_signals(signals=None):
+    r = await async_redis_handle()
     if signals is None:
         signals = []
-    for signal in r.smembers('signals'):
+    for signal in await r.smembers('signals'):
         signals.append(signal.decode('utf-8'))
     return signals
 
 
-def load_signal_database():
+@functools.lru_cache()
+def get_signal_archive():
+    path = get_settings().signal_archive_dir
+    if path:
+        from archive import SignalArchive  # pyarrow is only needed with an archive
+        return SignalArchive(path)
+
+
+def load_signal_store(signal, store):
+    """Replace the signal's store keeping the capacity and retention it was registered with."""
+    alerts = Alerts()
+    current = alerts.data.get(signal)
+    if current is not None:
+        store.reserve(capacity=current.capacity, retention=current.retention)
+    alerts.data[signal] = store
+
+
+async def load_signal_database(signals=None):
+    """Load the signal history, restricted to signals when given.
+
+    With an archive signals are loaded from it, falling back to the history
+    in Redis for signals the archive has no readings of (e.g. a new archive).
+    """
+    from persistence import SignalHistory
     logger.debug("Loading signal database")
     alerts = Alerts()
+    archive = get_signal_archive()
+    r = await async_redis_handle()
+    if signals is None:
+        signals = await get_signals()
+        if archive:
+            signals = sorted(set(signals) | set(archive.signals()))
+    if archive:
+        logger.debug(f"Loading signal database from {archive.path}")
+        missing = []
+        for signal in signals:
+            current = alerts.data.get(signal)
+            if current is None:
+                continue
+            store = archive.load(signal, retention=current.retention)
+            if not len(store):
+                missing.append(signal)
+                continue
+            SignalHistory().cursors[signal] = store.seq
+            load_signal_store(signal, store)
+        signals = missing
+    for signal, store in (await SignalHistory().replay(r, signals)).items():
+        load_signal_store(signal, store)
+
+
+def register_signal_store(signal_name, alert):
+    """Size the signal's store to cover the alert's timeframe."""
+    from store import SignalStore, capacity_for, timedelta_ns
+    alerts = Alerts()
+    capacity = capacity_for(alert.timeframe, alert.poll_rate)
+    retention = timedelta_ns(alert.timeframe)
+    store = alerts.data.get(signal_name)
+    if store is None:
+        alerts.data[signal_name] = SignalStore(
+            capacity=capacity, retention=retention,
+        )
+    else:
+        store.reserve(capacity=capacity, retention=retention)
+    return alerts.data[signal_name]
 
-    r = redis_handle()
-    context = pa.default_serialization_context()
-    signals = get_signals()
-    for signal in signals:
-        alerts.data[signal] = context.deserialize(r.get(signal))
+
+def action_name(action):
+    """Name of an alert action, unwrapping functools.partial."""
+    return getattr(getattr(action, 'func', action), '__name__', 'unknown')
 
 
 class AlertTask:
@@ -179,87 +301,268 @@ class AlertTask:
         self.loop = loop
         self.alert = alert
         self.signal = signal
-        self.signal_name = alert.condition.signal.lower()
+        self.signal_name = self.compiled.signal
         self.alert_action = alert_action
+        self.action_name = action_name(alert_action)
+        self.last_evaluated = None
+        register_signal_store(self.signal_name, alert)
 
     def __str__(self):
         return f"<AlertTask {self.alert}>"
 
+    @property
+    def alert(self):
+        return self._alert
+
+    @alert.setter
+    def alert(self, alert):
+        # Recompile whenever the alert is swapped out for an edited one
+        self._alert = alert
+        self.compiled = alert.compile()
+
+    @staticmethod
+    def signal_store(signal_name):
+        from store import SignalStore
+        signal_name = signal_name.lower()
+        alerts = Alerts()
+        store = alerts.data.get(signal_name)
+        if store is None:
+            store = alerts.data[signal_name] = SignalStore()
+        return store
+
     @classmethod
     def injest_reading(cls, signal_name, signal_value):
-        alerts = Alerts()
-        data_in = DataFrame([{
-            'timestamp': Timestamp.utcnow(),
-            'value': signal_value
-        }]).set_index('timestamp')
-        if alerts.data.get(signal_name) is None:
-            alerts.data[signal_name] = data_in
-        else:
-            alerts.data[signal_name] = pd.concat([alerts.data[signal_name], data_in])
-        return alerts.data[signal_name]
-
-    def truncate_to_alert_timeframe(self, df):
-        # Truncate to only data in the timeframe
-        return df[Timestamp.utcnow()-self.alert.timeframe_pd<df.index].dropna()
-
-    async def injest(self):
-        signal_value = await self.signal()
-        return self.injest_reading(self.signal_name, signal_value)
-
-    async def _calculate_signal_deviation(self, df):
+        """Append a reading taken now, dropped like in injest_readings if the
+        store already has a newer one."""
+        from store import now_ns
+        signal_name = signal_name.lower()
+        with SIGNAL_INJEST.time(signal_name):
+            store = cls.signal_store(signal_name)
+            timestamp = now_ns()
+            if len(store) and timestamp < store.timestamps[-1]:
+                logger.debug("Dropping a reading of %s older than its newest", signal_name)
+                return store
+            store.append(signal_value, timestamp)
+        SIGNAL_READINGS.inc(signal_name)
+        return store
+
+    @classmethod
+    def injest_readings(cls, signal_name, values, timestamps=None):
+        """Bulk append readings, returns how many were accepted.
+
+        Timestamps are ns since the epoch and default to now. Readings older
+        than the newest one already stored are dropped.
+        """
+        import numpy as np
+        from store import now_ns
+        signal_name = signal_name.lower()
+        with SIGNAL_INJEST.time(signal_name):
+            store = cls.signal_store(signal_name)
+            values = np.asarray(values, dtype=np.float64)
+            if timestamps is None:
+                timestamps = np.full(len(values), now_ns(), dtype=np.int64)
+            timestamps = np.asarray(timestamps, dtype=np.int64)
+            order = np.argsort(timestamps, kind='stable')
+            timestamps, values = timestamps[order], values[order]
+            if len(store):
+                keep = timestamps >= store.timestamps[-1]
+                timestamps, values = timestamps[keep], values[keep]
+            store.extend(values, timestamps)
+        SIGNAL_READINGS.inc(signal_name, amount=len(values))
+        return len(values)
+
+    @staticmethod
+    def signal_reading(first, last):
         # first, last
         # oldest, newest
         # min, max
-        first, last = self.alert.signal_read_strategy_func(df)
-
-        diff = get_deviation_percentage(first, last)
-        signal_reading = SignalReading(
+        return SignalReading(
             first=float(first),
             last=float(last),
             increased=float(first)<float(last),
-            diff=float(diff),
+            diff=float(get_deviation_percentage(first, last)),
+        )
+
+    def trace(self, event, signal_reading):
+        trace(
+            event, alert=self.compiled.id, signal=self.signal_name,
+            threshold=self.compiled.threshold, **signal_reading._asdict(),
         )
-        logger.debug(f"{self}: considering alerting ({self.alert.condition.difference} <= {diff}) for {signal_reading}")
-        if self.alert.condition.difference <= diff:
-            cooloff = self.alert.cooloff or self.alert.timeframe
-            logger.debug(f"{self}: Cmp {self.alert.last_notified} and {datetime.utcnow()} - {self.alert.last_notified} < {cooloff}")
-            if self.alert.last_notified and datetime.utcnow() - self.alert.last_notified < cooloff:
-                logger.debug(f"Alerted within the cooloff period ({cooloff}), skipping alert ({self.alert})...")
-                return
-            self.alert.last_notified = datetime.utcnow()
-            try:
+
+    async def notify(self, signal_reading):
+        """Run the alert action, the caller must have started the cooloff."""
+        self.alert.last_notified = datetime.utcnow()
+        if self.compiled.traced:
+            self.trace('notify', signal_reading)
+        try:
+            with ALERT_ACTION.time(self.action_name):
                 await self.alert_action(
                     self.alert,
                     signal_reading,
                 )
-            except Exception as e:
-                logger.error(f"{self}: Error in alert_action: {e}")
-                raise e
+        except Exception as e:
+            ALERT_ACTION_ERRORS.inc(self.action_name)
+            logger.error(f"{self}: Error in alert_action: {e}")
+            raise e
+
+    def due(self, now, tolerance=0):
+        """Whether poll_rate seconds (less tolerance) passed since the last evaluation."""
+        if self.last_evaluated is None:
+            return True
+        return now - self.last_evaluated >= self.compiled.poll_rate - tolerance
+
+
+class SignalSampler:
+    """Polls a signal once per tick and fans the reading out to every AlertTask on it.
+
+    The signal is polled at the fastest poll_rate among the subscribed alerts,
+    each alert is still only evaluated once its own poll_rate has elapsed.
+
+    Custom signals have nothing to poll (signal is None), readings are pushed
+    to them instead and every subscribed alert is evaluated shortly after.
+    """
+    def __init__(self, loop, signal_name, signal=None):
+        import numpy as np
+        self.loop = loop
+        self.signal_name = signal_name
+        self.signal = signal
+        self.subscribers = []
+        self.interval = None
+        self.task = None
+        self.pending = None
+        self.windows = np.empty(0, dtype=np.int64)
+        self.min_max = np.empty(0, dtype=bool)
+        self.thresholds = np.empty(0, dtype=np.float64)
+        self.traced = np.empty(0, dtype=np.intp)  # indexes of the subscribers being traced
+        self.notifying = set()  # alert actions still running
+
+    def __str__(self):
+        if self.push:
+            return f"<SignalSampler {self.signal_name} on push ({len(self.subscribers)} alerts)>"
+        return f"<SignalSampler {self.signal_name} every {self.interval}s ({len(self.subscribers)} alerts)>"
+
+    @property
+    def push(self):
+        return self.signal is None
+
+    def subscribe(self, alert_task, schedule):
+        import numpy as np
+        self.subscribers.append(alert_task)
+        alerts = [t.compiled for t in self.subscribers]
+        self.windows = np.array([a.window for a in alerts], dtype=np.int64)
+        self.min_max = np.array([a.min_max for a in alerts], dtype=bool)
+        self.thresholds = np.array([a.threshold for a in alerts], dtype=np.float64)
+        self.traced = np.flatnonzero([a.traced for a in alerts])
+        if self.push:
+            return None
+        poll_rate = alert_task.compiled.poll_rate
+        if self.interval is None or poll_rate < self.interval:
+            self.interval = poll_rate
+            if self.task:
+                self.task.cancel()
+            key = getattr(self.signal, 'schedule_key', None) or self.signal_name
+            self.task = schedule(self, interval=self.interval, key=key)
+        return self.task
+
+    def notify(self, debounce):
+        """Evaluate debounce seconds after the first of a burst of pushed readings."""
+        if self.pending is None:
+            self.pending = self.loop.call_later(debounce, self.evaluate_pushed)
+
+    def evaluate_pushed(self):
+        import numpy as np
+        self.pending = None
+        store = AlertTask.signal_store(self.signal_name)
+        due = np.ones(len(self.subscribers), dtype=bool)
+        self.loop.create_task(self.evaluate(store, time.monotonic(), due))
 
     async def __call__(self):
+        import numpy as np
         try:
-            df = await self.injest()
-            df = self.truncate_to_alert_timeframe(df)
+            with SIGNAL_FETCH.time(self.signal_name):
+                signal_value = await self.signal()
+            store = AlertTask.injest_reading(self.signal_name, signal_value)
         except Exception as e:
-            logger.debug(f"Error in injest: {e}")
-            raise e
+            SIGNAL_FETCH_ERRORS.inc(self.signal_name)
+            logger.warning(f"{self}: Error polling signal: {e}")
+            return
+        now = time.monotonic()
+        due = np.array([
+            alert_task.due(now, tolerance=self.interval / 2)
+            for alert_task in self.subscribers
+        ], dtype=bool)
+        await self.evaluate(store, now, due)
+
+    async def evaluate(self, store, now, due):
+        import numpy as np
+        from evaluate import evaluate_batch
+        with ALERT_EVALUATION.time(self.signal_name):
+            first, last, diff, fired = evaluate_batch(
+                store, self.windows, self.min_max, self.thresholds,
+            )
+        for i, alert_task in enumerate(self.subscribers):
+            if due[i]:
+                alert_task.last_evaluated = now
+        ALERTS_EVALUATED.inc(self.signal_name, amount=int(due.sum()))
+        if __debug__ and logger.isEnabledFor(logging.DEBUG):
+            for i in np.flatnonzero(due):
+                logger.debug(
+                    "%s: considering alerting (%s <= %s) first=%s last=%s",
+                    self.subscribers[i], self.thresholds[i], diff[i], first[i], last[i],
+                )
+        for i in self.traced:
+            if due[i]:
+                trace(
+                    'evaluate', alert=self.subscribers[i].compiled.id, signal=self.signal_name,
+                    threshold=self.thresholds[i], first=first[i], last=last[i], diff=diff[i],
+                )
+        candidates = [(i, self.subscribers[i]) for i in np.flatnonzero(due & fired)]
+        if not candidates:
+            return
+        ALERTS_FIRED.inc(self.signal_name, amount=len(candidates))
+        acquired = await CooldownRegistry().acquire_many([
+            (alert_task.compiled.id, alert_task.compiled.cooloff_ms)
+            for _, alert_task in candidates
+        ])
+        for i, alert_task in candidates:
+            if alert_task.compiled.id not in acquired:
+                ALERTS_COOLING.inc(self.signal_name)
+                if __debug__:
+                    logger.debug("Alerted within the cooloff period, skipping alert (%s)...", alert_task.alert)
+                if alert_task.compiled.traced:
+                    alert_task.trace('cooling', alert_task.signal_reading(first[i], last[i]))
+                continue
+            # Not awaited, so the alerts of a tick are queued together and
+            # can go out as one digest without holding up the next tick
+            task = self.loop.create_task(
+                self.send_notification(alert_task, alert_task.signal_reading(first[i], last[i])),
+            )
+            self.notifying.add(task)
+            task.add_done_callback(self.notifying.discard)
+
+    async def send_notification(self, alert_task, signal_reading):
         try:
-            await self._calculate_signal_deviation(df)
+            await alert_task.notify(signal_reading)
         except Exception as e:
-            logger.debug(f"Error in _calculate_signal_deviation: {e}")
-            raise e
+            logger.error(f"{alert_task}: Error evaluating alert: {e}")
+
+
+def notify_signal(signal_name):
+    """Evaluate the alerts on a custom signal after readings were pushed to it."""
+    sampler = Alerts().samplers.get(signal_name.lower())
+    if sampler is not None and sampler.push:
+        sampler.notify(get_settings().signal_push_debounce)
 
 
-def save_signal_database():
+async def save_signal_database():
+    from persistence import SignalHistory
     logger.debug("Saving signal database to redis")
-    r = redis_handle()
+    r = await async_redis_handle()
     alerts = Alerts()
-    context = pa.default_serialization_context()
-    for signal, df in alerts.data.items():
-        r.sadd(signal, context.serialize(df).to_buffer().to_pybytes())
-
-async def save_signal_database_async():
-    return save_signal_database()
+    archive = get_signal_archive()
+    if archive:
+        archive.flush(alerts.data)
+    return await SignalHistory().flush(r, alerts.data)
 
 
 @click.group()
@@ -273,20 +576,28 @@ def cli(verbose):
 def create_register_alert_task(alert, loop, schedule, func, **kwargs):
     signals = SignalMap()
     print("alert condition ", alert.condition)
-    signal = signals.value[alert.condition.signal.lower()]
+    signal_name = alert.condition.signal.lower()
+    samplers = Alerts().samplers
+    sampler = samplers.get(signal_name)
+    if sampler is None:
+        signal = signals.get(signal_name)
+        if signal is None:
+            logger.info(f"{signal_name} isn't a builtin signal, evaluating alerts on it when readings are pushed")
+        sampler = samplers[signal_name] = SignalSampler(
+            loop=loop,
+            signal_name=signal_name,
+            signal=signal and signal(loop=loop),
+        )
     update = AlertTask(
         loop=loop,
-        signal=signal(loop=loop),
+        signal=sampler.signal,
         alert=alert,
         alert_action=functools.partial(
             func,
             **kwargs,
         ),
     )
-    refresh_task = schedule(
-        update,
-        interval=alert.poll_rate,
-    )
+    refresh_task = sampler.subscribe(update, schedule)
     return update, refresh_task
 
 
@@ -299,19 +610,108 @@ def get_schedule(loop=None):
     )
 
 
-def process_alerts_from_file(file, func, **kwargs):
-    logger.debug(f"Processing alerts from file {file}")
+def run_alerts(alert_actions, sharded=False, metrics_port=None):
+    """Run (alert, action) pairs on a new event loop until stopped."""
     loop = asyncio.new_event_loop()
     schedule = get_schedule(loop)
+    if metrics_port:
+        loop.run_until_complete(metrics.serve(metrics_port))
 
-    for alert in Alert.load_collection(file):
-        create_register_alert_task(alert, loop, schedule, func, **kwargs)
+    for alert, action in alert_actions:
+        create_register_alert_task(alert, loop, schedule, action)
+    loop.run_until_complete(load_signal_database(
+        signals=list(Alerts().data) if sharded else None,
+    ))
 
     save_db_task = schedule(
-        save_signal_database_async,
+        save_signal_database,
+        key='save_signal_database',
     )
-    atexit.register(save_signal_database)
-    loop.run_forever()
+    loop.add_signal_handler(SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        notifying = [task for sampler in Alerts().samplers.values() for task in sampler.notifying]
+        if notifying:
+            loop.run_until_complete(asyncio.wait(notifying, timeout=10))
+        loop.run_until_complete(save_signal_database())
+        loop.run_until_complete(close_fetcher(loop))
+        cancel_tasks(loop)
+
+
+def process_alerts_from_file(file, func, **kwargs):
+    logger.debug(f"Processing alerts from file {file}")
+    action = functools.partial(func, **kwargs)
+    run_alerts(
+        ((alert, action) for alert in Alert.load_collection(file)),
+        metrics_port=get_settings().metrics_port,
+    )
+
+
+async def send_to_supervisor(alert, signal_reading, results, index):
+    results.put((index, tuple(signal_reading)))
+
+
+def run_alerts_shard(shard, shards, results, file, log_level):
+    """Worker process entrypoint, runs the alerts from file whose signal falls in shard."""
+    logger.setLevel(log_level)
+    logger.debug(f"Worker {shard}/{shards} processing alerts from file {file}")
+    metrics_port = get_settings().metrics_port
+    run_alerts((
+        (alert, functools.partial(send_to_supervisor, results=results, index=i))
+        for i, alert in enumerate(Alert.load_collection(file))
+        if shard_for(alert.condition.signal.lower(), shards) == shard
+    ), sharded=True, metrics_port=metrics_port and metrics_port + shard + 1)
+
+
+def supervise_alerts_from_file(file, workers, func, **kwargs):
+    """Shard the alerts in file by signal across worker processes.
+
+    Each worker polls and evaluates only its own signals, fired alerts are
+    sent back and their actions run here. With METRICS_PORT set the
+    supervisor serves its metrics on it and each worker on the port after
+    it plus the worker's shard.
+    """
+    logger.debug(f"Processing alerts from file {file} with {workers} workers")
+    alerts = Alert.load_collection(file)
+    action = functools.partial(func, **kwargs)
+    name = action_name(action)
+
+    async def on_result(result):
+        index, signal_reading = result
+        with ALERT_ACTION.time(name):
+            await action(alerts[index], SignalReading(*signal_reading))
+
+    supervisor = Supervisor(
+        target=run_alerts_shard,
+        args=(file, logger.level),
+        shards=sorted({
+            shard_for(alert.condition.signal.lower(), workers) for alert in alerts
+        }),
+        workers=workers,
+        on_result=on_result,
+    )
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    metrics_port = get_settings().metrics_port
+    if metrics_port:
+        loop.run_until_complete(metrics.serve(metrics_port))
+    loop.create_task(supervisor.supervise())
+    loop.create_task(supervisor.collect())
+    loop.add_signal_handler(SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        supervisor.stop()
+        if supervisor.handling:
+            loop.run_until_complete(asyncio.wait(list(supervisor.handling), timeout=10))
+        cancel_tasks(loop)
+
+
+def process_alerts(file, workers, func, **kwargs):
+    if workers > 1:
+        return supervise_alerts_from_file(file, workers, func, **kwargs)
+    return process_alerts_from_file(file, func, **kwargs)
 
 
 @cli.command()
@@ -325,13 +725,14 @@ def process_alerts_from_file(file, func, **kwargs):
     required=True,
     default=os.environ.get("MATRIX_PASSWORD"),
 )
-def matrix_room(file, host, user, password):
-    load_signal_database()
+@click.option('-w', '--workers', 'workers', type=int, default=1,
+              help='Worker processes to shard the alerts across by signal')
+def matrix_room(file, host, user, password, workers):
     matrix_config = MatrixConfig(
         host=host, user=user, password=password,
     )
-    process_alerts_from_file(
-        file, send_to_matrix_room,
+    process_alerts(
+        file, workers, send_to_matrix_room,
         matrix_config=matrix_config,
     )
 
@@ -339,10 +740,11 @@ def matrix_room(file, host, user, password):
 @cli.command()
 @click.option('-f', '--file', 'file', type=click.Path(),
               help='Alerts to load', required=True)
-def stdout(file):
-    load_signal_database()
-    process_alerts_from_file(
-        file, send_to_stdout,
+@click.option('-w', '--workers', 'workers', type=int, default=1,
+              help='Worker processes to shard the alerts across by signal')
+def stdout(file, workers):
+    process_alerts(
+        file, workers, send_to_stdout,
     )
 
 
@@ -351,16 +753,17 @@ def stdout(file):
               help='Alerts to load', required=True)
 @click.option('-o', '--out', 'out', type=click.Path(),
               help='Path to save alerts to', required=True)
-def file(file, out):
-    load_signal_database()
-    process_alerts_from_file(
-        file, functools.partial(send_to_file, file=out),
+@click.option('-w', '--workers', 'workers', type=int, default=1,
+              help='Worker processes to shard the alerts across by signal')
+def file(file, out, workers):
+    process_alerts(
+        file, workers, functools.partial(send_to_file, file=out),
     )
 
 
 @cli.command()
 def list_signals():
-    print("\n".join(SignalMap().value.keys()))
+    print("\n".join(SignalMap().names()))
 
 
 if __name__ == "__main__":
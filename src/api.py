@@ -1,17 +1,25 @@
 import asyncio
-from typing import Optional
+import json
+from typing import List, Optional
 
 from fastapi import FastAPI
+from pydantic import ValidationError, validator
+from starlette.requests import Request
 from starlette.responses import Response
+from starlette.websockets import WebSocket, WebSocketDisconnect
 from uvicorn.config import Config
 from uvicorn.main import Server
 
 from alerts import (
     Alert, AlertTask, create_register_alert_task, get_schedule,
-    MatrixConfig, send_to_matrix_room, SignalMap,
+    MatrixConfig, notify_signal, prime_templates, send_to_matrix_room,
+    SignalMap,
 )
+from c import get_settings
 from log import logger
+import metrics
 from model import BaseModel
+from store import now_ns
 from util import load_db, save_db
 
 app = FastAPI(version='0.1.0')
@@ -29,6 +37,41 @@ class SignalData(BaseModel):
     data: float
 
 
+# Earliest timestamp taken as ns, anything before 2001 was sent in s, ms or µs
+MIN_TIMESTAMP = 10**18
+
+
+def check_timestamps(timestamps, now):
+    """Raise ValueError for timestamps (ns) sent in another unit or further in
+    the future than the allowed clock skew, either would hold back every
+    reading after it."""
+    if not len(timestamps):
+        return
+    if min(timestamps) < MIN_TIMESTAMP:
+        raise ValueError('expected timestamps in ns since the epoch')
+    if max(timestamps) > now + int(get_settings().signal_max_clock_skew * 10**9):
+        raise ValueError('timestamps in the future')
+
+
+class SignalDataBatch(BaseModel):
+    name: str
+    data: List[float]
+    timestamps: Optional[List[int]]  # ns since the epoch, defaults to now
+
+    @validator('timestamps')
+    def timestamp_per_reading(cls, v, values):
+        if v is not None and 'data' in values and len(v) != len(values['data']):
+            raise ValueError('expected one timestamp per reading')
+        if v is not None:
+            check_timestamps(v, now_ns())
+        return v
+
+
+class SignalDataBatchResult(BaseModel):
+    accepted: int
+    dropped: int
+
+
 class MatrixAction(BaseModel):
     config_id: str
     alert_id: str
@@ -85,48 +128,208 @@ class API:
 #     return load_db(signal_id)
 
 
+def parse_readings(o):
+    """SignalDataBatch from a JSON reading or batch of readings."""
+    if isinstance(o, dict) and not isinstance(o.get('data'), list):
+        reading = SignalData(**o)
+        timestamp = o.get('timestamp')
+        return SignalDataBatch(
+            name=reading.name,
+            data=[reading.data],
+            timestamps=None if timestamp is None else [timestamp],
+        )
+    return SignalDataBatch.parse_obj(o)
+
+
+def group_readings(batches, now):
+    """Merge batches into one (values, timestamps) per signal."""
+    signals = {}
+    for batch in batches:
+        values, timestamps = signals.setdefault(batch.name.lower(), ([], []))
+        values.extend(batch.data)
+        timestamps.extend(batch.timestamps or [now] * len(batch.data))
+    return signals
+
+
+def read_ndjson(body, now):
+    return group_readings(
+        (parse_readings(json.loads(line)) for line in body.splitlines() if line.strip()),
+        now,
+    )
+
+
+def read_arrow(body, now):
+    """Readings from an Arrow IPC stream with name, data and optionally timestamp columns."""
+    import pyarrow as pa
+    try:
+        frame = pa.ipc.open_stream(body).read_pandas()
+    except pa.ArrowException as e:
+        raise ValueError(e) from e
+    if 'timestamp' not in frame:
+        frame['timestamp'] = now
+    frame['timestamp'] = frame['timestamp'].fillna(now).astype('int64')
+    check_timestamps(frame['timestamp'].to_numpy(), now)
+    frame['name'] = frame['name'].str.lower()
+    return {
+        name: (group['data'].to_numpy(), group['timestamp'].to_numpy())
+        for name, group in frame.groupby('name', sort=False)
+    }
+
+
+def builtin_signals(signals):
+    return {name for name in signals if SignalMap().get(name) is not None}
+
+
+def injest_signals(signals):
+    """Bulk append readings grouped by signal, readings for builtin signals are dropped."""
+    builtin = builtin_signals(signals)
+    accepted = dropped = 0
+    for name, (values, timestamps) in signals.items():
+        if name in builtin:
+            dropped += len(values)
+            continue
+        count = AlertTask.injest_readings(name, values, timestamps)
+        if count:
+            notify_signal(name)
+        accepted += count
+        dropped += len(values) - count
+    return SignalDataBatchResult(accepted=accepted, dropped=dropped)
+
+
 @app.post("/signal/data", status_code=204, response_class=Response)
-def injest_signal_data(o: SignalData) -> None:
+async def injest_signal_data(o: SignalData) -> None:
     """Post a reading for a custom Signal."""
-    if o.name in SignalMap().value.keys():
+    if builtin_signals([o.name.lower()]):
         return Response(content='Unable to injest data for builtin signals', status_code=403)
     AlertTask.injest_reading(o.name, o.data)
+    notify_signal(o.name)
+
+
+@app.post("/signal/data/batch", response_model=SignalDataBatchResult)
+async def injest_signal_data_batch(o: List[SignalDataBatch]) -> SignalDataBatchResult:
+    """Post readings for many custom Signals at once, readings for builtin
+    signals are dropped."""
+    return injest_signals(group_readings(o, now_ns()))
+
+
+@app.post("/signal/data/stream", response_model=SignalDataBatchResult)
+async def injest_signal_data_stream(request: Request) -> SignalDataBatchResult:
+    """Post readings as NDJSON or, with an application/vnd.apache.arrow.stream
+    content type, as an Arrow IPC stream. Readings for builtin signals are dropped."""
+    body = await request.body()
+    now = now_ns()
+    try:
+        if request.headers.get('content-type', '').startswith('application/vnd.apache.arrow'):
+            signals = read_arrow(body, now) if body else {}
+        else:
+            signals = read_ndjson(body, now)
+    except (ValueError, KeyError, ValidationError) as e:
+        return Response(content=f'Unable to parse readings: {e}', status_code=400)
+    return injest_signals(signals)
+
+
+async def discard_stream(queue):
+    while await queue.get() is not None:
+        pass
+
+
+async def apply_stream(websocket, queue):
+    """Apply queued messages in bulk, acknowledging each bulk.
+
+    If applying fails the socket is closed with an error and the rest of the
+    queue is discarded so the receive loop never blocks on a full queue.
+    """
+    closed = False
+    while not closed:
+        messages = [await queue.get()]
+        while not queue.empty():
+            messages.append(queue.get_nowait())
+        closed = None in messages
+        batches = []
+        for m in filter(None, messages):
+            try:
+                o = json.loads(m)
+                batches.extend(map(parse_readings, o if isinstance(o, list) else [o]))
+            except (ValueError, ValidationError) as e:
+                logger.debug(f"Bad signal data on stream: {e}")
+                if not closed:
+                    await websocket.send_json({'error': f'Unable to parse readings: {e}'})
+        try:
+            result = injest_signals(group_readings(batches, now_ns()))
+        except Exception as e:
+            logger.error(f"Error injesting signal data from stream: {e}")
+            if not closed:
+                await websocket.send_json({'error': f'Unable to injest readings: {e}'})
+                await websocket.close(code=1011)
+                await discard_stream(queue)
+            return
+        if not closed:
+            await websocket.send_json(result.dict())
+
+
+@app.websocket("/signal")
+async def stream_signal_data(websocket: WebSocket):
+    """Stream readings for custom Signals, a JSON reading or list of readings per message.
+
+    Messages wait on a bounded queue and are applied in bulk. While the queue
+    is full the socket isn't read from, so a client sending faster than we
+    injest is pushed back on instead of buffered without bound.
+    """
+    await websocket.accept()
+    queue = asyncio.Queue(maxsize=get_settings().signal_stream_queue_size)
+    applier = asyncio.ensure_future(apply_stream(websocket, queue))
+    try:
+        while not applier.done():
+            await queue.put(await websocket.receive_text())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if not applier.done():
+            await queue.put(None)
+        await applier
+
+
+@app.get("/metrics", response_class=Response)
+async def get_metrics() -> Response:
+    """Metrics in the Prometheus text format."""
+    return Response(content=metrics.render(), media_type=metrics.MEDIA_TYPE)
 
 
 @app.post("/alert", response_model=SaveAlertResult)
-def new_alert(o: Alert) -> SaveAlertResult:
+async def new_alert(o: Alert) -> SaveAlertResult:
     """New alert."""
-    return save_db(o).to_dict()
+    prime_templates([o])
+    return (await save_db(o)).to_dict()
 
 
 @app.get("/alert/{alert_id}", response_model=Alert)
-def get_alert(alert_id) -> Alert:
+async def get_alert(alert_id) -> Alert:
     """Get alert by ID."""
-    return load_db(alert_id)
+    return await load_db(alert_id)
 
 
 @app.post("/matrix/config", response_model=SaveMatrixResult)
-def new_matrix_config(o: MatrixConfig) -> SaveMatrixResult:
+async def new_matrix_config(o: MatrixConfig) -> SaveMatrixResult:
     """New Matrix Config."""
-    return save_db(o).to_dict()
+    return (await save_db(o)).to_dict()
 
 
 @app.get("/matrix/config/{matrix_config_id}", response_model=MatrixConfig)
-def get_matrix_config(matrix_config_id) -> MatrixConfig:
+async def get_matrix_config(matrix_config_id) -> MatrixConfig:
     """Get Matrix Config by ID."""
-    return load_db(matrix_config_id)
+    return await load_db(matrix_config_id)
 
 
 @app.post("/matrix/action", response_model=SaveMatrixActionResult)
-def new_matrix_action(o: MatrixAction) -> SaveMatrixActionResult:
+async def new_matrix_action(o: MatrixAction) -> SaveMatrixActionResult:
     """New Matrix Action."""
-    return save_db(o).to_dict()
+    return (await save_db(o)).to_dict()
 
 
 @app.get("/matrix/action/{action_id}", response_model=MatrixAction)
-def load_matrix_action(action_id: str) -> MatrixAction:
+async def load_matrix_action(action_id: str) -> MatrixAction:
     """Get Matrix Action by ID."""
-    return load_db(action_id)
+    return await load_db(action_id)
 
 
 @app.post("/matrix/action/{action_id}/register", status_code=204, response_class=Response)
@@ -139,9 +342,10 @@ async def register_matrix_action(action_id: str) -> None:
         return Response(content=None, status_code=409)
 
     schedule = get_schedule(loop)
-    action = load_db(action_id)
-    matrix_config = load_db(action.config_id)
-    alert = load_db(action.alert_id)
+    action = await load_db(action_id)
+    matrix_config = await load_db(action.config_id)
+    alert = await load_db(action.alert_id)
+    prime_templates([alert])
     update_task, refresh_task = create_register_alert_task(
         alert, loop, schedule,
         send_to_matrix_room,
@@ -0,0 +1,213 @@
+import bisect
+import os
+import shutil
+
+import numpy as np
+import pyarrow as pa
+
+from log import logger
+from store import SignalStore, SignalWindow, now_ns
+
+schema = pa.schema([
+    ('timestamp', pa.int64()),
+    ('value', pa.float64()),
+])
+
+
+class SignalArchive:
+    """Columnar on-disk signal history in Arrow IPC files.
+
+    Readings are laid out as <path>/<signal>/<partition start>/<first>-<last>.arrow
+    where partitions span partition_size ns and every flush writes one chunk
+    with the readings appended since the previous flush. Closed partitions
+    are compacted into a single chunk and partitions that fell out of the
+    store's retention are deleted. Reads memory-map only the chunks that
+    overlap the requested range.
+    """
+    partition_size = 3600 * 10**9
+
+    def __init__(self, path, partition_size=None):
+        self.path = path
+        self.partition_size = partition_size or self.partition_size
+        self.cursors = {}
+        self.known = {}  # signal -> start timestamps of its partitions, oldest first
+        self.uncompacted = {}  # signal -> partitions written to since they were compacted
+
+    def signals(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(
+            d for d in os.listdir(self.path)
+            if os.path.isdir(os.path.join(self.path, d))
+        )
+
+    def partitions(self, signal):
+        """Start timestamps of the signal's partitions, oldest first."""
+        known = self.known.get(signal)
+        if known is None:
+            known = self.known[signal] = self._list_partitions(signal)
+            self.uncompacted[signal] = set(known)
+        return known
+
+    def _list_partitions(self, signal):
+        path = os.path.join(self.path, signal)
+        if not os.path.isdir(path):
+            return []
+        for d in os.listdir(path):
+            if d.endswith('.old'):
+                self._recover(os.path.join(path, d[:-len('.old')]))
+        return sorted(int(d) for d in os.listdir(path) if d.isdigit())
+
+    @staticmethod
+    def _recover(path):
+        """Finish a compaction interrupted between swapping the partitions."""
+        if os.path.isdir(path):
+            shutil.rmtree(f'{path}.old')
+        else:
+            os.replace(f'{path}.old', path)
+
+    def chunks(self, signal, partition):
+        """(first, last, path) of each chunk in a partition, oldest first."""
+        path = os.path.join(self.path, signal, str(partition))
+        chunks = []
+        for f in os.listdir(path):
+            if not f.endswith('.arrow'):
+                continue
+            first, last = f[:-len('.arrow')].split('-')
+            chunks.append((int(first), int(last), os.path.join(path, f)))
+        return sorted(chunks)
+
+    def _write_chunk(self, path, timestamps, values):
+        os.makedirs(path, exist_ok=True)
+        name = f'{timestamps[0]}-{timestamps[-1]}.arrow'
+        table = pa.Table.from_arrays(
+            [pa.array(timestamps, pa.int64()), pa.array(values, pa.float64())],
+            schema=schema,
+        )
+        tmp = os.path.join(path, f'.{name}.tmp')
+        with pa.OSFile(tmp, 'wb') as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, os.path.join(path, name))
+
+    def write(self, signal, timestamps, values):
+        """Write readings (sorted by timestamp) split into their partitions."""
+        if not len(timestamps):
+            return
+        partitions = timestamps - timestamps % self.partition_size
+        bounds = np.flatnonzero(np.diff(partitions)) + 1
+        for ts, vs in zip(np.split(timestamps, bounds), np.split(values, bounds)):
+            partition = int(ts[0] - ts[0] % self.partition_size)
+            self._write_chunk(
+                os.path.join(self.path, signal, str(partition)), ts, vs,
+            )
+            known = self.partitions(signal)
+            if partition not in known:
+                bisect.insort(known, partition)
+            self.uncompacted[signal].add(partition)
+
+    def flush(self, stores):
+        """Write readings appended since the last flush, then prune and compact
+        closed partitions."""
+        written = 0
+        for signal, store in stores.items():
+            window = store.since(self.cursors.get(signal, 0))
+            self.cursors[signal] = store.seq
+            if not len(window):
+                continue
+            self.write(signal, window.timestamps, window.values)
+            self.prune(signal, self.cutoff(store, now_ns()))
+            self.compact(signal)
+            written += len(window)
+        logger.debug("Archived %s readings for %s signals", written, len(stores))
+        return written
+
+    @staticmethod
+    def cutoff(store, now):
+        """Timestamp before which readings can't be loaded back into the store."""
+        if store.retention is not None:
+            return now - store.retention
+        if len(store) == store.capacity:
+            return int(store.timestamps[0])
+
+    def prune(self, signal, cutoff):
+        """Delete partitions holding only readings older than cutoff (ns)."""
+        if cutoff is None:
+            return
+        known = self.partitions(signal)
+        while len(known) > 1 and known[0] + self.partition_size <= cutoff:
+            partition = known.pop(0)
+            self.uncompacted[signal].discard(partition)
+            shutil.rmtree(os.path.join(self.path, signal, str(partition)))
+
+    def compact(self, signal):
+        """Merge the chunks of each closed partition written to since its last
+        compaction into one.
+
+        The merged chunk is written to a staging directory that's swapped in
+        with renames, a partition moved aside as .old is restored or removed
+        the next time the signal's partitions are listed.
+        """
+        known = self.partitions(signal)
+        uncompacted = self.uncompacted[signal]
+        for partition in sorted(uncompacted):
+            if partition == known[-1]:
+                continue
+            uncompacted.discard(partition)
+            chunks = self.chunks(signal, partition)
+            if len(chunks) < 2:
+                continue
+            window = self._read_chunks(chunks)
+            path = os.path.join(self.path, signal, str(partition))
+            staging = f'{path}.compact'
+            shutil.rmtree(staging, ignore_errors=True)
+            self._write_chunk(staging, window.timestamps, window.values)
+            os.replace(path, f'{path}.old')
+            os.replace(staging, path)
+            shutil.rmtree(f'{path}.old')
+
+    def _read_chunks(self, chunks, since=None):
+        timestamps, values = [], []
+        for _, _, path in chunks:
+            with pa.memory_map(path, 'r') as source:
+                table = pa.ipc.open_file(source).read_all()
+            timestamps.append(table.column('timestamp').to_numpy())
+            values.append(table.column('value').to_numpy())
+        if not timestamps:
+            return SignalWindow(
+                np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64),
+            )
+        timestamps, values = np.concatenate(timestamps), np.concatenate(values)
+        i = 0 if since is None else int(np.searchsorted(timestamps, since, side='right'))
+        return SignalWindow(timestamps[i:], values[i:])
+
+    def read(self, signal, since=None, until=None):
+        """Readings newer than since (ns) from the chunks overlapping [since, until]."""
+        chunks = []
+        for partition in self.partitions(signal):
+            if until is not None and partition > until:
+                break
+            if since is not None and partition + self.partition_size <= since:
+                continue
+            chunks.extend(
+                chunk for chunk in self.chunks(signal, partition)
+                if since is None or chunk[1] > since
+            )
+        window = self._read_chunks(chunks, since)
+        if until is not None:
+            i = int(np.searchsorted(window.timestamps, until, side='right'))
+            window = SignalWindow(window.timestamps[:i], window.values[:i])
+        return window
+
+    def load(self, signal, retention=None, now=None):
+        """SignalStore with the signal's readings within retention ns of now."""
+        since = None if retention is None else (now or now_ns()) - retention
+        window = self.read(signal, since=since)
+        store = SignalStore(
+            capacity=max(len(window), SignalStore.default_capacity),
+            retention=retention,
+        )
+        for timestamp, value in zip(window.timestamps, window.values):
+            store.append(value, int(timestamp))
+        self.cursors[signal] = store.seq
+        return store
@@ -1,21 +1,69 @@
-from typing import Optional
+import asyncio
+import functools
+from typing import List, Optional
+import weakref
 
 from pydantic import BaseSettings
-import redis
+
+from metrics import Histogram
+
+REDIS_ROUNDTRIP = Histogram(
+    'redis_roundtrip_seconds', 'Time spent in Redis round trips', ['op'],
+)
 
 
 class Settings(BaseSettings):
     glassnode_api_key: Optional[str]
     redis_host: str = '127.0.0.1'
     redis_port: int = 6379
+    redis_pool_size: int = 10
+    signal_archive_dir: Optional[str]
+    scheduler_concurrency: int = 64
+    scheduler_catch_up: str = 'skip'  # skip, burst or delay, see scheduler.CatchUp
+    signal_stream_queue_size: int = 1024
+    signal_push_debounce: float = 0.1  # seconds to coalesce pushed readings over
+    signal_max_clock_skew: float = 60  # seconds pushed readings can be ahead of this host's clock
+    metrics_port: Optional[int]  # serve /metrics from the CLI on this port
+    trace_sample_rate: float = 0.0  # fraction of alerts to trace evaluations of
+    trace_alerts: List[str] = []  # ids of alerts to always trace
+    http_timeout: float = 10  # seconds
+    http_concurrency: int = 10  # connections per event loop
+    host_disk_mounts: List[str] = ['/']  # mounts to register server_disk_usage_* signals for
 
     class Config:
         env_file = '.env'
 
 
-def redis_handle():
-    settings = Settings().dict()
-    return redis.Redis(
-        host=settings['redis_host'],
-        port=settings['redis_port'],
+@functools.lru_cache()
+def get_settings():
+    return Settings()
+
+
+async def create_async_redis_handle():
+    import aioredis
+    settings = get_settings()
+    return await aioredis.create_redis_pool(
+        (settings.redis_host, settings.redis_port),
+        maxsize=settings.redis_pool_size,
     )
+
+
+async_redis_handles = weakref.WeakKeyDictionary()
+
+
+def usable(handle):
+    if not handle.done():
+        return True
+    return not handle.cancelled() and handle.exception() is None\
+        and not handle.result().closed
+
+
+async def async_redis_handle():
+    """Pooled aioredis client shared by everything running on the current event loop."""
+    loop = asyncio.get_event_loop()
+    handle = async_redis_handles.get(loop)
+    if handle is None or not usable(handle):
+        handle = async_redis_handles[loop] = loop.create_task(
+            create_async_redis_handle(),
+        )
+    return await asyncio.shield(handle)
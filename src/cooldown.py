@@ -0,0 +1,68 @@
+import time
+
+from c import REDIS_ROUNDTRIP, async_redis_handle
+from log import logger
+
+
+def cooldown_key(alert_id):
+    return f'alert_cooldown:{alert_id}'
+
+
+class CooldownRegistry:
+    """Alert cooloffs shared through Redis so they survive restarts and hold
+    across replicas.
+
+    Starting a cooloff is a SET NX PX on the alert's key, only the caller that
+    sets it gets to notify. Cooloffs seen are cached locally until they expire
+    so alerts still cooling off don't cost a round trip.
+    """
+    __shared_state = {}
+
+    def __init__(self):
+        self.__dict__ = self.__shared_state
+        try:
+            self.until
+        except AttributeError:
+            self.until = {}  # alert id -> time.monotonic() the cooloff ends
+
+    def cooling(self, alert_id, now):
+        return self.until.get(alert_id, 0) > now
+
+    async def acquire_many(self, cooloffs):
+        """Start the cooloff (ms) of every (alert id, cooloff) pair not already
+        cooling off in one pipeline, returns the ids that were started.
+
+        If Redis can't be reached cooloffs are only tracked locally, it's
+        better to risk a duplicate alert than to drop one.
+        """
+        now = time.monotonic()
+        pending = [(i, ms) for i, ms in cooloffs if not self.cooling(i, now)]
+        if not pending:
+            return set()
+        try:
+            r = await async_redis_handle()
+            pipe = r.pipeline()
+            futures = [
+                (
+                    pipe.set(
+                        cooldown_key(alert_id), int(time.time() * 1000),
+                        pexpire=max(int(ms), 1), exist=r.SET_IF_NOT_EXIST,
+                    ),
+                    pipe.pttl(cooldown_key(alert_id)),
+                )
+                for alert_id, ms in pending
+            ]
+            with REDIS_ROUNDTRIP.time('cooldown'):
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Unable to check cooloffs in redis, falling back to local state: {e}")
+            for alert_id, ms in pending:
+                self.until[alert_id] = now + ms / 1000
+            return {alert_id for alert_id, _ in pending}
+        acquired = set()
+        for (alert_id, ms), (started, ttl) in zip(pending, futures):
+            if started.result():
+                acquired.add(alert_id)
+            remaining = ttl.result()
+            self.until[alert_id] = now + (remaining if remaining > 0 else ms) / 1000
+        return acquired
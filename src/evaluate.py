@@ -0,0 +1,44 @@
+import numpy as np
+
+from store import MinMaxEvaluator, now_ns
+
+
+def deviation_percentage(first, last):
+    """Vectorized util.get_deviation_percentage, nan where it is undefined
+    (an empty window or a last reading of 0)."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diff = np.round(np.abs(1 - (first / last)) * 100)
+    diff[~np.isfinite(diff)] = np.nan
+    return diff
+
+
+def evaluate_batch(store, windows, min_max, thresholds, timestamp=None):
+    """Evaluate every alert on one signal in a single pass over its store.
+
+    windows holds each alert's timeframe in ns, min_max whether it reads the
+    window with the min_max strategy and thresholds its difference. Window
+    starts for oldest_newest alerts come from one searchsorted over the
+    timestamps. min_max alerts sharing a timeframe share one incremental
+    MinMaxEvaluator. Returns (first, last, diff, fired) arrays, first and
+    last are nan for alerts whose window is empty and diff is nan, so the
+    alert doesn't fire, where the deviation is undefined.
+    """
+    timestamp = timestamp or now_ns()
+    count = len(windows)
+    first = np.full(count, np.nan)
+    last = np.full(count, np.nan)
+    values = store.values
+    if len(values):
+        starts = np.searchsorted(store.timestamps, timestamp - windows, side='right')
+        oldest_newest = ~min_max & (starts < len(values))
+        first[oldest_newest] = values[starts[oldest_newest]]
+        last[oldest_newest] = values[-1]
+    for window in np.unique(windows[min_max]):
+        reading = store.evaluator(MinMaxEvaluator, int(window)).read(timestamp)
+        if reading is not None:
+            selected = min_max & (windows == window)
+            first[selected], last[selected] = reading
+    diff = deviation_percentage(first, last)
+    with np.errstate(invalid='ignore'):
+        fired = thresholds <= diff
+    return first, last, diff, fired
@@ -0,0 +1,89 @@
+import asyncio
+import weakref
+
+from c import get_settings
+from log import logger
+from metrics import Counter
+
+HTTP_REQUESTS = Counter(
+    'http_requests_total', 'HTTP GETs by whether they were cached, joined an in-flight request or fetched', ['outcome'],
+)
+
+
+class Fetcher:
+    """HTTP GETs for everything running on one event loop.
+
+    Requests share one connection pooled session. Concurrent GETs of the same
+    URL wait on a single request and responses are kept for the ttl the
+    caller asks for, so signals polled by many alerts or fetching the same
+    API hit it once.
+    """
+    def __init__(self, loop, timeout=10, limit=10):
+        self.loop = loop
+        self.timeout = timeout
+        self.limit = limit
+        self.session = None
+        self.in_flight = {}
+        self.cache = {}  # url -> (expires at loop.time(), text)
+
+    async def get_session(self):
+        if self.session is None or self.session.closed:
+            import aiohttp
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def request(self, url):
+        session = await self.get_session()
+        async with session.get(url) as response:
+            status = response.status
+            data = await response.text()
+        if status != 200:
+            logger.warning(f"Error communicating with signal API (HTTP Code {status}): {data}")
+            raise ValueError(f"HTTP {status} from {url}")
+        return data
+
+    async def get(self, url, ttl=0):
+        """Response text of url, cached for ttl seconds."""
+        cached = self.cache.get(url)
+        if cached is not None and cached[0] > self.loop.time():
+            HTTP_REQUESTS.inc('cached')
+            return cached[1]
+        task = self.in_flight.get(url)
+        if task is None:
+            HTTP_REQUESTS.inc('fetched')
+            task = self.in_flight[url] = self.loop.create_task(self.request(url))
+            task.add_done_callback(lambda _: self.in_flight.pop(url, None))
+        else:
+            HTTP_REQUESTS.inc('joined')
+        # Shielded so one caller being cancelled doesn't cancel the others
+        data = await asyncio.shield(task)
+        if ttl:
+            self.cache[url] = (self.loop.time() + ttl, data)
+        return data
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+fetchers = weakref.WeakKeyDictionary()
+
+
+def get_fetcher(loop=None):
+    loop = loop or asyncio.get_event_loop()
+    fetcher = fetchers.get(loop)
+    if fetcher is None:
+        settings = get_settings()
+        fetcher = fetchers[loop] = Fetcher(
+            loop, timeout=settings.http_timeout, limit=settings.http_concurrency,
+        )
+    return fetcher
+
+
+async def close_fetcher(loop):
+    fetcher = fetchers.pop(loop, None)
+    if fetcher is not None:
+        await fetcher.close()
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import time
+
+
+class HostSnapshot:
+    """Host metrics as of one tick, each read at most once, when first used."""
+    def __init__(self):
+        import psutil  # only once a host signal is polled, not to list signals
+        self.psutil = psutil
+        self.readings = {}
+
+    def read(self, key, func, *args):
+        try:
+            return self.readings[key]
+        except KeyError:
+            value = self.readings[key] = func(*args)
+            return value
+
+    @property
+    def load(self):
+        return self.read('load', os.getloadavg)
+
+    @property
+    def memory(self):
+        return self.read('memory', self.psutil.virtual_memory)
+
+    @property
+    def swap(self):
+        return self.read('swap', self.psutil.swap_memory)
+
+    @property
+    def cpu(self):
+        """Utilization (%) of all CPUs since the previous snapshot read it."""
+        return self.read('cpu', self.psutil.cpu_percent)
+
+    @property
+    def cpus(self):
+        """Utilization (%) of each CPU since the previous snapshot read it."""
+        return self.read('cpus', self.psutil.cpu_percent, None, True)
+
+    def disk(self, mount):
+        return self.read(('disk', mount), self.psutil.disk_usage, mount)
+
+
+class HostMetrics:
+    """Hands every server_* signal polled within ttl seconds the same snapshot.
+
+    psutil measures CPU utilization since its previous call and reads 0 on
+    the first, so CPU signals prime it when they're created and their first
+    poll waits until at least cpu_interval seconds were measured.
+    """
+    __shared_state = {}
+    ttl = 1
+    cpu_interval = 0.1
+
+    def __init__(self):
+        self.__dict__ = self.__shared_state
+        try:
+            self.current
+        except AttributeError:
+            self.current = None
+            self.taken = 0
+            self.cpu_primed = None
+
+    def prime_cpu(self):
+        if self.cpu_primed is None:
+            import psutil
+            psutil.cpu_percent()
+            psutil.cpu_percent(percpu=True)
+            self.cpu_primed = time.monotonic()
+
+    async def cpu_ready(self):
+        self.prime_cpu()
+        wait = self.cpu_primed + self.cpu_interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def snapshot(self):
+        now = time.monotonic()
+        if self.current is None or now - self.taken >= self.ttl:
+            self.current = HostSnapshot()
+            self.taken = now
+        return self.current
@@ -1,18 +1,26 @@
+import abc
 import asyncio
-import aiohttp
 import argparse
-from datetime import datetime
+import atexit
+import collections
+from datetime import datetime, timedelta
+import enum
 import functools
 import json
 import pickle
 import os
+import re
+import signal
 import socket
 import subprocess
 import sys
 import logging
+import time
+from typing import NamedTuple
+import zlib
 
-from nio import AsyncClient
-from nio.responses import RoomResolveAliasResponse
+# nio and aiohttp are imported where they're used, enqueueing a message
+# (what the cron driven one-shot sends do) needs neither.
 
 logging.basicConfig(
     format='%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s',
@@ -20,7 +28,23 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-state_file = os.path.join(
+# Hot paths log with %-style arguments, formatted only when the record is
+# emitted, inside `if __debug__:` so python -O compiles the call out.
+trace_logger = logging.getLogger('trace')
+trace_logger.setLevel(logging.INFO)
+
+
+def sampled(key, rate):
+    """Whether key falls in the sampled fraction rate, the same on every call and run."""
+    return zlib.crc32(key.encode('utf-8')) % 10000 < rate * 10000
+
+
+def trace(event, **fields):
+    """Structured trace record, a JSON object per line."""
+    trace_logger.info(json.dumps({'event': event, **fields}, default=str))
+
+# Room ids and log shipping cursors, keep it on a volume when in a container
+state_file = os.getenv('LOG_STATE_FILE') or os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
     'state.pickle',
 )
@@ -36,8 +60,10 @@ def get_state():
 
 def save_state(state):
     get_state.cache_clear()
-    with open(state_file, 'wb') as f:
+    tmp = f'{state_file}.tmp'
+    with open(tmp, 'wb') as f:
         f.write(pickle.dumps(state))
+    os.replace(tmp, state_file)
 
 
 def shell_exec(cmd_str):
@@ -68,6 +94,7 @@ def read_data():
 
 
 async def get_client(args):
+    from nio import AsyncClient
     client = AsyncClient(args.host, args.user)
     if args.password:
         await client.login(
@@ -76,68 +103,686 @@ async def get_client(args):
     return client
 
 
-async def get_room(args, alias):
-    logger.debug(f"Get room with alias {alias}")
-    state = get_state()
-    room = state['rooms'].get(alias)
-    client = await get_client(args)
-    if room:
-        logger.debug(f"Returning cached room_id for {alias}: {room}")
-        await client.close()
-        return room
-    resolve_response = await client.room_resolve_alias(f'#{alias}:{args.host.lstrip("https://")}')
-    if isinstance(resolve_response, RoomResolveAliasResponse):
-        logger.debug(f"resolved {alias} to {resolve_response.room_id}")
-        state['rooms'][alias] = resolve_response.room_id
-    else:
-        room = await client.room_create(alias=alias, name=alias, topic='log', federate=False)
-        logger.debug(f"created {alias} to {room.room_id}")
-        state['rooms'][alias] = room.room_id
-    save_state(state)
-    await client.close()
-    return state['rooms'][alias]
+class MatrixSender:
+    """Long lived Matrix clients shared by everything sending in this process.
+
+    Clients are kept logged in per host and user, resolved room ids are
+    cached in memory and written to the state file shortly after they change
+    instead of on every lookup. A client whose token expired or whose
+    connection failed is logged in again and the send retried once.
+    """
+    __shared_state = {}
+    write_behind_delay = 5
+
+    def __init__(self):
+        self.__dict__ = self.__shared_state
+        try:
+            self.clients
+        except AttributeError:
+            self.clients = {}
+            self.locks = {}
+            self.rooms = dict(get_state()['rooms'])
+            self.flush_handle = None
+            atexit.register(self.flush_state)
+
+    async def client(self, args):
+        key = (args.host, args.user)
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            client = self.clients.get(key)
+            if client is None:
+                logger.debug(f"Logging in to {args.host} as {args.user}")
+                client = self.clients[key] = await get_client(args)
+            return client
+
+    async def close(self):
+        self.flush_state()
+        for key in list(self.clients):
+            await self.clients.pop(key).close()
+
+    async def reset(self, args):
+        client = self.clients.pop((args.host, args.user), None)
+        if client is not None:
+            await client.close()
+
+    def flush_state(self):
+        self.flush_handle = None
+        state = get_state()
+        if state['rooms'] != self.rooms:
+            save_state({**state, 'rooms': dict(self.rooms)})
+
+    def schedule_flush(self):
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(
+                self.write_behind_delay, self.flush_state,
+            )
+
+    async def room(self, args, alias):
+        room = self.rooms.get(alias)
+        if room:
+            logger.debug("Returning cached room_id for %s: %s", alias, room)
+            return room
+        from nio.responses import RoomResolveAliasResponse
+        client = await self.client(args)
+        resolve_response = await client.room_resolve_alias(f'#{alias}:{args.host.lstrip("https://")}')
+        if isinstance(resolve_response, RoomResolveAliasResponse):
+            logger.debug(f"resolved {alias} to {resolve_response.room_id}")
+            self.rooms[alias] = resolve_response.room_id
+        else:
+            room = await client.room_create(alias=alias, name=alias, topic='log', federate=False)
+            logger.debug(f"created {alias} to {room.room_id}")
+            self.rooms[alias] = room.room_id
+        self.schedule_flush()
+        return self.rooms[alias]
+
+    async def _send(self, args, body):
+        room = await self.room(args, args.room)
+        client = await self.client(args)
+        return await client.room_send(
+            room_id=room,
+            message_type="m.room.message",
+            content={
+                "msgtype": "m.text",
+                "body": body,
+            }
+        )
+
+    async def send(self, args, body):
+        import aiohttp
+        from nio.responses import ErrorResponse
+        try:
+            ret = await self._send(args, body)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Error sending to {args.room}, reconnecting: {e}")
+            await self.reset(args)
+            return await self._send(args, body)
+        if isinstance(ret, ErrorResponse) and ret.status_code in ('M_UNKNOWN_TOKEN', 'M_MISSING_TOKEN'):
+            logger.warning(f"Access token for {args.user} rejected, logging in again")
+            await self.reset(args)
+            return await self._send(args, body)
+        return ret
 
 
 async def main(args, format_func=format_message):
-    room = await get_room(args, args.room)
-    client = await get_client(args)
-    ret = await client.room_send(
-        room_id=room,
-        message_type="m.room.message",
-        content={
-            "msgtype": "m.text",
-            "body": format_func(args.message),
-        }
+    priority = getattr(args, 'priority', None) or Priority.normal
+    return await Dispatcher().send(args, format_func(args.message), priority)
+
+
+class Priority(str, enum.Enum):
+    critical = 'critical'
+    normal = 'normal'
+    low = 'low'
+
+
+LANES = (Priority.critical, Priority.normal, Priority.low)  # drained in this order
+
+
+class TokenBucket:
+    """rate tokens a second, holding at most burst."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, now):
+        """Seconds until a token is available."""
+        self.refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+class Outgoing(NamedTuple):
+    body: str
+    future: asyncio.Future
+    queued: float  # time.monotonic()
+
+
+class RoomQueue:
+    """Messages waiting to be sent to one room, a FIFO per priority."""
+    def __init__(self, args, rate, burst):
+        self.args = args
+        self.lanes = {priority: collections.deque() for priority in LANES}
+        self.bucket = TokenBucket(rate, burst)
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def next_lane(self):
+        for priority in LANES:
+            lane = self.lanes[priority]
+            while lane and lane[0].future.done():  # Sender gave up on it
+                lane.popleft()
+            if lane:
+                return priority
+        return None
+
+    def take(self, priority, max_bytes):
+        """Messages of the next digest from a lane, always at least one."""
+        lane = self.lanes[priority]
+        batch = [lane.popleft()]
+        size = len(batch[0].body)
+        while lane and size + len(lane[0].body) + 1 <= max_bytes:
+            outgoing = lane.popleft()
+            if not outgoing.future.done():
+                batch.append(outgoing)
+                size += len(outgoing.body) + 1
+        return batch
+
+    def size(self, priority):
+        return sum(len(outgoing.body) + 1 for outgoing in self.lanes[priority])
+
+
+class Dispatcher:
+    """Rate limited sends to Matrix rooms shared by everything sending in this process.
+
+    Every room has a token bucket, a message takes a token to send. Messages
+    queued for a room while it waits for tokens, or within digest_window of
+    the first of them, are merged into a single digest of up to max_bytes.
+    Critical messages skip the digest window and are sent before any normal
+    then low priority message.
+
+    Homeservers rate limit per user, so a 429 (M_LIMIT_EXCEEDED) pauses
+    every room sent to as that user for the retry-after it gives, then the
+    messages are sent again. Any other error response fails every message
+    in the digest with a ValueError.
+
+    Defaults follow Synapse's default message rate limit and can be set with
+    the MATRIX_ROOM_RATE (messages a second), MATRIX_ROOM_BURST and
+    MATRIX_DIGEST_WINDOW (seconds) environment variables.
+    """
+    __shared_state = {}
+    max_bytes = 16000
+
+    def __init__(self):
+        self.__dict__ = self.__shared_state
+        try:
+            self.rooms
+        except AttributeError:
+            self.rooms = {}
+            self.paused_until = {}  # (host, user) -> time.monotonic() a 429 lifts
+            self.rate = float(os.getenv('MATRIX_ROOM_RATE', 0.2))
+            self.burst = float(os.getenv('MATRIX_ROOM_BURST', 10))
+            self.digest_window = float(os.getenv('MATRIX_DIGEST_WINDOW', 2))
+            self.stats = {'queued': 0, 'sent': 0, 'rate_limited': 0, 'failed': 0}
+
+    async def send(self, args, body, priority=Priority.normal):
+        """Queue body for args.room, returns the response to the send it went out in."""
+        key = (args.host, args.user, args.room)
+        room = self.rooms.get(key)
+        if room is None:
+            room = self.rooms[key] = RoomQueue(args, self.rate, self.burst)
+        future = asyncio.get_event_loop().create_future()
+        room.lanes[Priority(priority)].append(Outgoing(body, future, time.monotonic()))
+        self.stats['queued'] += 1
+        room.wakeup.set()
+        if room.task is None or room.task.done():
+            room.task = asyncio.ensure_future(self.run(room))
+        return await future
+
+    async def send_digest(self, args, body):
+        return await MatrixSender().send(args, body)
+
+    def wait(self, room, priority, now):
+        """Seconds until the next digest from the lane can be sent."""
+        paused = self.paused_until.get((room.args.host, room.args.user), 0) - now
+        window = 0
+        if priority != Priority.critical and room.size(priority) < self.max_bytes:
+            window = room.lanes[priority][0].queued + self.digest_window - now
+        return max(paused, room.bucket.wait(now), window)
+
+    async def sleep(self, room, seconds):
+        """Sleep, waking early if a message is queued in case it's critical."""
+        room.wakeup.clear()
+        try:
+            await asyncio.wait_for(room.wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self, room):
+        """Send the room's messages until none are left."""
+        from nio.responses import ErrorResponse
+        while True:
+            priority = room.next_lane()
+            if priority is None:
+                return
+            now = time.monotonic()
+            wait = self.wait(room, priority, now)
+            if wait > 0:
+                await self.sleep(room, wait)
+                continue
+            batch = room.take(priority, self.max_bytes)
+            room.bucket.take(now)
+            try:
+                ret = await self.send_digest(room.args, '\n'.join(outgoing.body for outgoing in batch))
+                if isinstance(ret, ErrorResponse) and ret.status_code == 'M_LIMIT_EXCEEDED':
+                    retry_after = (ret.retry_after_ms or 1000) / 1000
+                    logger.warning(f"Rate limited sending to {room.args.room}, retrying in {retry_after}s")
+                    self.stats['rate_limited'] += 1
+                    self.paused_until[(room.args.host, room.args.user)] = time.monotonic() + retry_after
+                    room.lanes[priority].extendleft(reversed(batch))
+                    continue
+                if isinstance(ret, ErrorResponse):
+                    raise ValueError(f"Error sending to {room.args.room}: {ret}")
+            except Exception as e:
+                self.stats['failed'] += 1
+                for outgoing in batch:
+                    if not outgoing.future.done():
+                        outgoing.future.set_exception(e)
+                continue
+            self.stats['sent'] += 1
+            logger.debug("Sent %s messages to %s in one digest", len(batch), room.args.room)
+            for outgoing in batch:
+                if not outgoing.future.done():
+                    outgoing.future.set_result(ret)
+
+
+def post_json(url, o, timeout=10):
+    import urllib.error
+    import urllib.request
+    request = urllib.request.Request(
+        url, data=json.dumps(o).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
     )
-    await client.close()
-    return ret
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.read().decode('utf-8')
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode('utf-8')
 
 
 async def enqueue(args):
-    session = aiohttp.ClientSession()
     url = os.getenv('MESSAGE_QUEUE')
     if not url:
         raise ValueError("MESSAGE_QUEUE environment variable is not set!")
     m = args.__dict__
     m['message'] = format_message(m['message'])
-    async with session.post(url, json=m) as response:
-        status = response.status
-        data = await response.text()
-        if status != 200:
-            logger.warning(f"Error communicating with signal API (HTTP Code {status}): {data}")
-        assert status == 200
-        return url, data
+    status, data = await asyncio.get_event_loop().run_in_executor(None, post_json, url, m)
+    if status != 200:
+        logger.warning(f"Error communicating with signal API (HTTP Code {status}): {data}")
+    assert status == 200
+    return url, data
+
+
+async def deliver(args, body):
+    """Send body to args.room through the message queue if MESSAGE_QUEUE is set, directly otherwise."""
+    if os.getenv('MESSAGE_QUEUE'):
+        return await enqueue(argparse.Namespace(**vars(args), message=body, priority=Priority.low))
+    return await Dispatcher().send(args, format_message(body), Priority.low)
+
+
+STREAM_LIMIT = 2**20  # longest line read from a pipe
+
+
+TIMESTAMP = re.compile(
+    r'(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})(?:[.,](\d+))?(Z|[+-]\d{2}:?\d{2})?'
+)
+
+
+def utc_timestamp(dt=None):
+    return (dt or datetime.utcnow()).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def parse_timestamp(line):
+    """UTC timestamp of the ISO 8601 time line starts with (UTC unless it
+    has an offset), truncated to microseconds, or None."""
+    match = TIMESTAMP.match(line.lstrip())
+    if match is None:
+        return None
+    date, time_, fraction, offset = match.groups()
+    try:
+        dt = datetime.strptime(f'{date}T{time_}', '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+    dt = dt.replace(microsecond=int((fraction or '0')[:6].ljust(6, '0')))
+    if offset and offset != 'Z':
+        sign = -1 if offset[0] == '-' else 1
+        hours, minutes = int(offset[1:3]), int(offset[-2:])
+        dt -= sign * timedelta(hours=hours, minutes=minutes)
+    return utc_timestamp(dt)
+
+
+class LineSource(abc.ABC):
+    """Stream of (line, cursor) pairs, the cursor being where to resume after the line.
+
+    name is the key the cursor of the last delivered line is saved under.
+    """
+    def __init__(self, name, cursor=None):
+        self.name = name
+        self.cursor = cursor
+
+    @abc.abstractmethod
+    def lines(self):
+        """Async iterator of (line, cursor) pairs."""
+
+
+class StdinSource(LineSource):
+    """Lines from stdin until EOF, stdin can't be resumed so there's no cursor."""
+    async def lines(self):
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader(limit=STREAM_LIMIT)
+        try:
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        except ValueError:  # Redirected from a regular file
+            for line in sys.stdin:
+                yield line.rstrip('\n'), None
+                await asyncio.sleep(0)
+            return
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            yield line.decode('utf-8', 'replace').rstrip('\n'), None
+
+
+class FileSource(LineSource):
+    """Follows a file like tail -F, the cursor is its (inode, offset).
+
+    Without a cursor only lines written from now on are read. A file that is
+    replaced or truncated is read again from the start.
+    """
+    poll_interval = 1
+
+    def __init__(self, name, path, cursor=None):
+        super().__init__(name, cursor)
+        self.path = path
+
+    def open(self):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        st = os.fstat(f.fileno())
+        if self.cursor is None:
+            f.seek(0, os.SEEK_END)
+        elif self.cursor[0] == st.st_ino and self.cursor[1] <= st.st_size:
+            f.seek(self.cursor[1])
+        self.cursor = (st.st_ino, f.tell())
+        return f
+
+    def replaced(self, f):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False  # Keep reading the old file until the new one shows up
+        return st.st_ino != self.cursor[0] or st.st_size < f.tell()
+
+    async def lines(self):
+        f = None
+        try:
+            while True:
+                if f is None:
+                    f = self.open()
+                    if f is None:
+                        await asyncio.sleep(self.poll_interval)
+                        continue
+                line = f.readline()
+                if line.endswith(b'\n'):
+                    self.cursor = (self.cursor[0], f.tell())
+                    yield line.decode('utf-8', 'replace').rstrip('\n'), self.cursor
+                    await asyncio.sleep(0)
+                    continue
+                f.seek(-len(line), os.SEEK_CUR)  # Wait for the rest of a partial line
+                if self.replaced(f):
+                    logger.info("%s was replaced, reading it from the start", self.path)
+                    f.close()
+                    f = None
+                    self.cursor = (None, 0)
+                    continue
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            if f is not None:
+                f.close()
+
+
+class CommandSource(LineSource):
+    """Lines a shell command writes to stdout and stderr, the cursor is the
+    timestamp the last line started with (e.g. docker logs --timestamps) or,
+    for commands that don't print one, the time the last line was read.
+
+    The command is run again restart_delay seconds after it exits with
+    {since} replaced by the cursor, or by since the first time, e.g.
+    `docker service logs --follow --since {since} web`.
+    """
+    def __init__(self, name, command, cursor=None, since='1m', restart_delay=5):
+        super().__init__(name, cursor)
+        self.command = command
+        self.since = since
+        self.restart_delay = restart_delay
+        self.timestamped = False  # whether any line started with a timestamp
+
+    async def lines(self):
+        while True:
+            command = self.command.replace('{since}', self.cursor or self.since)
+            logger.debug("Running %s", command)
+            process = await asyncio.create_subprocess_shell(
+                command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, limit=STREAM_LIMIT,
+                start_new_session=True,  # own process group, stopped along with whatever it runs
+            )
+            try:
+                while True:
+                    line = await process.stdout.readline()
+                    if not line:
+                        break
+                    line = line.decode('utf-8', 'replace').rstrip('\n')
+                    timestamp = parse_timestamp(line)
+                    if timestamp is not None:
+                        self.timestamped = True
+                        self.cursor = timestamp
+                    elif not self.timestamped:
+                        self.cursor = utc_timestamp()
+                    yield line, self.cursor
+            except BaseException:  # Stopped while the command runs
+                if process.returncode is None:
+                    try:
+                        os.killpg(process.pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+                raise
+            code = await process.wait()
+            logger.debug("%s exited with %s, running it again in %ss", command, code, self.restart_delay)
+            await asyncio.sleep(self.restart_delay)
+
+
+def parse_tail(spec, cursors, since='1m', restart_delay=5):
+    """(room, LineSource) from ROOM=SOURCE, the source being - for stdin,
+    !command for a shell command or otherwise a file path."""
+    room, sep, source = spec.partition('=')
+    if not sep or not room or not source:
+        raise ValueError(f"Expected ROOM=SOURCE, got {spec}")
+    cursor = cursors.get(spec)
+    if source == '-':
+        return room, StdinSource(spec)
+    if source.startswith('!'):
+        return room, CommandSource(spec, source[1:], cursor, since=since, restart_delay=restart_delay)
+    return room, FileSource(spec, source, cursor)
+
+
+class LogShipper:
+    """Batches lines per room into messages of up to max_bytes, sent once
+    max_delay seconds passed since the first line was buffered or as soon as
+    a message is full. One send per room is in flight at a time, so lines
+    arrive in order.
+
+    The cursor of a source is saved once every line up to it was sent, so a
+    restart resumes after the last delivered line. A failed send keeps its
+    lines buffered and is retried after max_delay, lines beyond
+    max_buffered bytes per room are dropped oldest first.
+    """
+    write_behind_delay = 5
+
+    def __init__(self, args, max_bytes=16000, max_delay=5, max_buffered=2**22, send=deliver):
+        self.args = args
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.max_buffered = max_buffered
+        self.send = send
+        self.buffers = {}  # room -> [(line, size, source, cursor)]
+        self.sizes = {}  # room -> bytes buffered
+        self.timers = {}
+        self.locks = {}
+        self.waiting = set()  # rooms with a flush waiting on the one in flight
+        self.flushes = set()
+        self.cursors = dict(get_state().get('cursors', {}))
+        self.save_handle = None
+
+    def add(self, room, source, line, cursor):
+        encoded = line.encode('utf-8')
+        if len(encoded) >= self.max_bytes:
+            line = encoded[:self.max_bytes - 4].decode('utf-8', 'ignore') + '...'
+            encoded = line.encode('utf-8')
+        buffer = self.buffers.setdefault(room, [])
+        buffer.append((line, len(encoded) + 1, source, cursor))
+        self.sizes[room] = self.sizes.get(room, 0) + len(encoded) + 1
+        if self.sizes[room] > self.max_buffered:
+            logger.warning("Dropping lines buffered for %s beyond %s bytes", room, self.max_buffered)
+            while self.sizes[room] > self.max_buffered:
+                self.sizes[room] -= buffer.pop(0)[1]
+        if self.sizes[room] >= self.max_bytes:
+            self.flush_soon(room, full_only=True)
+        else:
+            self.schedule_flush(room)
+
+    def schedule_flush(self, room):
+        if room not in self.timers:
+            self.timers[room] = asyncio.get_event_loop().call_later(
+                self.max_delay, self.flush_soon, room,
+            )
+
+    def flush_soon(self, room, full_only=False):
+        if full_only and room in self.waiting:
+            return
+        if not full_only:
+            timer = self.timers.pop(room, None)
+            if timer is not None:
+                timer.cancel()
+        self.waiting.add(room)
+        task = asyncio.ensure_future(self.flush(room, full_only))
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    def take(self, room):
+        """Lines of the next message for room, removed from its buffer."""
+        buffer = self.buffers[room]
+        size = i = 0
+        while i < len(buffer) and size + buffer[i][1] <= self.max_bytes:
+            size += buffer[i][1]
+            i += 1
+        batch = buffer[:i]
+        del buffer[:i]
+        self.sizes[room] -= size
+        return batch
+
+    async def flush(self, room, full_only=False):
+        """Send the lines buffered for room, or only full messages of them."""
+        args = argparse.Namespace(
+            host=self.args.host, user=self.args.user, password=self.args.password, room=room,
+        )
+        async with self.locks.setdefault(room, asyncio.Lock()):
+            self.waiting.discard(room)
+            while self.buffers.get(room) and (not full_only or self.sizes[room] >= self.max_bytes):
+                batch = self.take(room)
+                try:
+                    await self.send(args, '\n'.join(line for line, _, _, _ in batch))
+                except Exception as e:
+                    logger.warning(f"Error sending {len(batch)} lines to {room}, retrying in {self.max_delay}s: {e}")
+                    self.buffers[room][:0] = batch
+                    self.sizes[room] += sum(size for _, size, _, _ in batch)
+                    self.schedule_flush(room)
+                    return
+                logger.debug("Sent %s lines to %s", len(batch), room)
+                for _, _, source, cursor in batch:
+                    if cursor is not None:
+                        self.cursors[source] = cursor
+                self.schedule_save()
+            if self.buffers.get(room):
+                self.schedule_flush(room)
+
+    def save_cursors(self):
+        self.save_handle = None
+        state = get_state()
+        if state.get('cursors') != self.cursors:
+            save_state({**state, 'cursors': dict(self.cursors)})
+
+    def schedule_save(self):
+        if self.save_handle is None:
+            self.save_handle = asyncio.get_event_loop().call_later(
+                self.write_behind_delay, self.save_cursors,
+            )
+
+    async def follow(self, room, source):
+        async for line, cursor in source.lines():
+            self.add(room, source.name, line, cursor)
+
+    async def close(self):
+        """Send everything buffered and save the cursors."""
+        for room, buffer in self.buffers.items():
+            if buffer:
+                self.flush_soon(room)
+        if self.flushes:
+            await asyncio.wait(list(self.flushes))
+        if self.save_handle is not None:
+            self.save_handle.cancel()
+        self.save_cursors()
+
+
+async def ship(args):
+    """Ship lines from every --tail source until they're exhausted or SIGTERM/SIGINT."""
+    loop = asyncio.get_event_loop()
+    shipper = LogShipper(args, max_bytes=args.batch_bytes, max_delay=args.batch_delay)
+    sources = [
+        parse_tail(spec, shipper.cursors, since=args.since, restart_delay=args.restart_delay)
+        for spec in args.tail
+    ]
+    stopped = loop.create_future()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda: stopped.done() or stopped.set_result(None))
+    tasks = [loop.create_task(shipper.follow(room, source)) for room, source in sources]
+    try:
+        pending = set(tasks)
+        while pending and not stopped.done():
+            done, _ = await asyncio.wait(pending | {stopped}, return_when=asyncio.FIRST_COMPLETED)
+            pending -= done
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await shipper.close()
+        if MatrixSender().clients:
+            await MatrixSender().close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Matrix Logger')
     parser.add_argument('--host', required=True, help='Synapse host.')
-    parser.add_argument('--room', required=True, help='Room to send to.')
+    parser.add_argument('--room', help='Room to send to.')
     parser.add_argument('--user', required=True)
     parser.add_argument('--password', default=os.environ.get("MATRIX_PASSWORD"), help='User password. Defaults to MATRIX_PASSWORD environment variable')
-    parser.add_argument('--message', default=read_data(), help='Message to send. Defaults to STDIN')
+    parser.add_argument('--message', help='Message to send. Defaults to STDIN')
+    parser.add_argument(
+        '--tail', action='append', metavar='ROOM=SOURCE',
+        help='Run as a daemon shipping lines from SOURCE to ROOM, SOURCE is - for STDIN, '
+        '!command for the output of a shell command or else a file path. Repeatable.',
+    )
+    parser.add_argument('--batch-bytes', type=int, default=16000, help='Largest message lines are batched into.')
+    parser.add_argument('--batch-delay', type=float, default=5, help='Seconds to batch lines for before sending.')
+    parser.add_argument('--since', default='1m', help='Replaces {since} in a command until it has a cursor.')
+    parser.add_argument('--restart-delay', type=float, default=5, help='Seconds before running an exited command again.')
     parser.add_argument('--verbose', action='store_true')
     args = parser.parse_args()
     if args.verbose:
         logger.setLevel('DEBUG')
-    asyncio.get_event_loop().run_until_complete(enqueue(args))
+    if args.tail:
+        asyncio.get_event_loop().run_until_complete(ship(args))
+    else:
+        if not args.room:
+            parser.error('--room is required without --tail')
+        if args.message is None:
+            args.message = read_data()
+        asyncio.get_event_loop().run_until_complete(enqueue(args))
@@ -1,9 +1,10 @@
 import asyncio
-from typing import Optional
-import json
+import functools
 import random
 import os
 import logging
+import socket
+import time
 
 from fastapi import FastAPI
 import pydantic
@@ -12,10 +13,12 @@ from starlette.responses import Response
 from uvicorn.config import Config
 from uvicorn.main import Server
 
-from alerts import MatrixLog
-from log import main as send_matrix_message
+from c import REDIS_ROUNDTRIP
+from log import Dispatcher, Priority, main as send_matrix_message
 from api import API
-from util import redis_handle
+import metrics
+from metrics import Counter, Gauge, Histogram
+from util import async_redis_handle
 
 app = FastAPI(version='0.1.0')
 
@@ -26,17 +29,46 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+QUEUE_DEPTH = Gauge('message_queue_depth', 'Messages waiting in a queue', ['queue'])
+MESSAGE_SEND = Histogram('message_send_seconds', 'Time sending a message to Matrix')
+MESSAGES_DELIVERED = Counter('messages_delivered_total', 'Messages sent to Matrix')
+MESSAGES_FAILED = Counter(
+    'messages_failed_total', 'Messages that failed to send, by whether they were requeued', ['outcome'],
+)
+DISPATCHER_STATS = Counter(
+    'matrix_dispatcher_total',
+    'Messages queued, digests sent, sends rate limited by the homeserver and sends failed', ['event'],
+)
+
+
+def collect_dispatcher_stats():
+    for event, count in Dispatcher().stats.items():
+        DISPATCHER_STATS.set(count, event)
+
+
+metrics.collectors.append(collect_dispatcher_stats)
+
 
 class Settings(BaseSettings):
     matrix_user: str
     matrix_host: str
     matrix_password: str
-    delivery_interval: int = 5 # in minutes
+    batch_size: int = 100 # messages drained per wakeup
+    send_concurrency: int = 4 # rooms sent to concurrently
+    block_timeout: int = 5 # seconds to block waiting for a message
+    retry_delay: float = 1 # seconds before the first retry of a failed message, doubled each attempt
+    max_retry_delay: float = 300 # seconds
+
+
+@functools.lru_cache()
+def get_settings():
+    return Settings()
 
 
 class MessageInjest(BaseModel):
     room: str
     message: str
+    priority: Priority = Priority.normal
 
 
 class Message(MessageInjest):
@@ -49,82 +81,185 @@ class MessageDelivery(BaseModel):
     message: MessageInjest
     attempts: int = 0
     max_attempts: int = 10
+    retry_at: float = 0  # time.time() the next attempt is due
+
+
+# Moves messages whose retry is due from the delayed set back to the queue,
+# in a script so two consumers can't both requeue one
+REQUEUE_DUE = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, m in ipairs(due) do
+    redis.call('ZREM', KEYS[1], m)
+    redis.call('RPUSH', KEYS[2], m)
+end
+return #due
+"""
 
 
 async def sleep_time():
-    asyncio.sleep(random.choice(range(1000, 5000))/1000)
+    await asyncio.sleep(random.choice(range(1000, 5000))/1000)
+
+
+def processing_queue():
+    """Per consumer list holding messages that were received but not yet delivered."""
+    return f'injest:processing:{socket.gethostname()}'
 
 
-async def sleep_weighted(r, minutes=5):
-    """Sleep weighted by the client delivery interval and queue size."""
-    count = r.llen('injest')
-    seconds = minutes*60
+async def requeue_processing(r, processing):
+    """Return messages left over by a previous run of this consumer to the queue."""
+    count = 0
+    while await r.rpoplpush(processing, 'injest'):
+        count += 1
     if count:
-        w=seconds/count
-        logger.debug(f" Sleeping for {w} ({count} messages in the queue, client push interval assumed to be every {minutes} minutes)")
-        asyncio.sleep(w)
-
-
-async def send_message(r, m):
-    logger.debug("Dequeue")
-    settings = Settings()
-    await sleep_weighted(r, minutes=settings.delivery_interval)
-    d = json.loads(m.decode('utf-8'))
-    logger.debug(f"Processing message: {d}")
-    if d['attempts'] >= d['max_attempts']:
-        logger.warning("Max tries hit for message.")
-        logger.debug(f"Message content: {d}")
-        await sleep_time()
-        return (await dequeue())
+        logger.warning(f"Requeued {count} undelivered messages from {processing}")
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter before the given attempt."""
+    settings = get_settings()
+    delay = min(settings.retry_delay * 2 ** (attempts - 1), settings.max_retry_delay)
+    return delay * random.uniform(0.5, 1)
+
+
+async def requeue_due(r, batch_size):
+    """Return messages whose retry is due to the queue."""
+    with REDIS_ROUNDTRIP.time('requeue_due'):
+        return await r.eval(
+            REQUEUE_DUE, keys=['injest:delayed', 'injest'], args=[time.time(), batch_size],
+        )
+
+
+async def receive_messages(r, processing, batch_size, timeout):
+    """Block until a message arrives then drain up to batch_size messages.
+
+    The blocking pop gets a connection to itself, commands on the pool's
+    shared connections would otherwise wait behind it.
+    """
+    with await r as conn, REDIS_ROUNDTRIP.time('receive'):
+        m = await conn.brpoplpush('injest', processing, timeout=timeout)
+    if not m:
+        return []
+    pipe = r.pipeline()
+    futures = [pipe.rpoplpush('injest', processing) for _ in range(batch_size - 1)]
+    with REDIS_ROUNDTRIP.time('receive_drain'):
+        await pipe.execute()
+    return [m] + [m for m in (f.result() for f in futures) if m]
+
+
+def group_by_room(messages):
+    rooms = {}
+    for m in messages:
+        try:
+            delivery = MessageDelivery.parse_raw(m)
+        except pydantic.ValidationError as e:
+            logger.warning(f"Bad message encountered: {e}")
+            logger.debug(f"Bad message content: {m}")
+            delivery = None
+        room = delivery.message.room if delivery else None
+        rooms.setdefault(room, []).append((m, delivery))
+    return rooms
+
+
+async def send_message(delivery):
+    settings = get_settings()
+    logger.debug("Processing message: %s", delivery)
     ret = await send_matrix_message(
         Message(
-            **d['message'],
+            **delivery.message.dict(),
             host=settings.matrix_host,
             password=settings.matrix_password,
             user=settings.matrix_user,
         ),
         format_func=lambda s: s,
     )
-    logger.debug(f"Sent message and got back: {ret}")
+    logger.debug("Sent message and got back: %s", ret)
     return ret
 
 
-async def dequeue_messages():
-    async def dequeue():
-        r = redis_handle()
-        m = r.rpop('injest')
-        if not m:
-            await sleep_time()
-            return (await dequeue())
+async def deliver(r, processing, m, delivery):
+    """Send a message then acknowledge it, on failure it's retried after a backoff."""
+    pipe = r.pipeline()
+    pipe.lrem(processing, 1, m)
+    if delivery is not None:
         try:
-            await send_message(r, m)
+            with MESSAGE_SEND.time():
+                await send_message(delivery)
+            MESSAGES_DELIVERED.inc()
         except Exception as e:
             logger.warning(f"Caught an error while sending message: {e}")
-            if type(e) == pydantic.error_wrappers.ValidationError:
-                logger.warning("Bad message encountered")
-                logger.debug(f"Bad message content: {m}")
+            delivery.attempts += 1
+            if delivery.attempts < delivery.max_attempts:
+                MESSAGES_FAILED.inc('requeued')
+                delivery.retry_at = time.time() + retry_delay(delivery.attempts)
+                pipe.zadd('injest:delayed', delivery.retry_at, delivery.json())
             else:
-                r.rpush('injest', m)
-        await sleep_time()
-        return (await dequeue())
-    try:
-        await dequeue()
-    except Exception as e:
-        logger.warning(f"Caught an error while running dequeue: {e}")
-        await sleep_time()
-        return (await dequeue_messages())
+                MESSAGES_FAILED.inc('dropped')
+                logger.warning("Max tries hit for message.")
+                logger.debug(f"Message content: {delivery}")
+    with REDIS_ROUNDTRIP.time('ack'):
+        await pipe.execute()
+
+
+async def deliver_room(r, processing, messages, semaphore):
+    # Queued together so the dispatcher can merge them into digests
+    async with semaphore:
+        await asyncio.gather(*(
+            deliver(r, processing, m, delivery) for m, delivery in messages
+        ))
+
+
+async def dequeue_messages():
+    settings = get_settings()
+    semaphore = asyncio.Semaphore(settings.send_concurrency)
+    processing = processing_queue()
+    r = await async_redis_handle()
+    await requeue_processing(r, processing)
+    while True:
+        try:
+            await requeue_due(r, settings.batch_size)
+            messages = await receive_messages(
+                r, processing, settings.batch_size, settings.block_timeout,
+            )
+            if not messages:
+                continue
+            logger.debug("Dequeued %s messages", len(messages))
+            await asyncio.gather(*(
+                deliver_room(r, processing, room_messages, semaphore)
+                for room_messages in group_by_room(messages).values()
+            ))
+        except Exception as e:
+            logger.warning(f"Caught an error while running dequeue: {e}")
+            await sleep_time()
 
 
 @app.post("/")
 async def save_message(m: MessageInjest):
     """Save message."""
     api = API()
-    logger.debug(f"Enqueue message: {m}")
+    logger.debug("Enqueue message: %s", m)
     if not api.tasks.get('dequeue'):
         logger.debug("Initializing dequeue task")
         api.tasks['dequeue'] = asyncio.ensure_future(dequeue_messages())
     delivery = MessageDelivery(message=m)
-    return redis_handle().lpush('injest', delivery.json())
+    r = await async_redis_handle()
+    with REDIS_ROUNDTRIP.time('enqueue'):
+        return await r.lpush('injest', delivery.json())
+
+
+@app.get("/metrics", response_class=Response)
+async def get_metrics() -> Response:
+    """Metrics in the Prometheus text format."""
+    r = await async_redis_handle()
+    pipe = r.pipeline()
+    pipe.llen('injest')
+    pipe.llen(processing_queue())
+    pipe.zcard('injest:delayed')
+    with REDIS_ROUNDTRIP.time('queue_depth'):
+        waiting, processing, delayed = await pipe.execute()
+    QUEUE_DEPTH.set(waiting, 'injest')
+    QUEUE_DEPTH.set(processing, 'processing')
+    QUEUE_DEPTH.set(delayed, 'delayed')
+    return Response(content=metrics.render(), media_type=metrics.MEDIA_TYPE)
 
 
 def start_uvicorn():
@@ -0,0 +1,144 @@
+import asyncio
+from bisect import bisect_left
+import time
+
+from log import logger
+
+MEDIA_TYPE = 'text/plain; version=0.0.4'
+CONTENT_TYPE = f'{MEDIA_TYPE}; charset=utf-8'
+DEFAULT_BUCKETS = (
+    .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30,
+)
+
+registry = {}
+collectors = []  # Called before rendering to refresh metrics derived from other state
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+
+class Metric:
+    """Preaggregated metric, one value per combination of label values.
+
+    Label values are passed positionally in the order of labels.
+    """
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        registry[name] = self
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, tuple(zip(self.labels, labels)), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+
+class Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Histogram(Metric):
+    """Counts observations into fixed buckets, cumulated only when rendered."""
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        counts = self.values.get(labels)
+        if counts is None:
+            # One count per bucket then +Inf, then the sum of observations
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, *labels):
+        """Context manager observing the time spent in its body."""
+        return Timer(self, labels)
+
+    def samples(self):
+        for labels, counts in self.values.items():
+            labels = tuple(zip(self.labels, labels))
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield f'{self.name}_bucket', labels + (('le', bound),), total
+            yield f'{self.name}_sum', labels, counts[-1]
+            yield f'{self.name}_count', labels, total
+
+
+def render():
+    """Every registered metric in the Prometheus text format."""
+    for collect in collectors:
+        try:
+            collect()
+        except Exception as e:
+            logger.warning(f"Error collecting metrics: {e}")
+    return '\n'.join(m.render() for m in registry.values()) + '\n'
+
+
+async def handle_scrape(reader, writer):
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = render().encode('utf-8')
+        writer.write(
+            b'HTTP/1.1 200 OK\r\n'
+            + f'Content-Type: {CONTENT_TYPE}\r\n'.encode('utf-8')
+            + f'Content-Length: {len(body)}\r\n'.encode('utf-8')
+            + b'Connection: close\r\n\r\n'
+            + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError) as e:
+        logger.debug(f"Bad metrics request: {e}")
+    finally:
+        writer.close()
+
+
+async def serve(port, host='0.0.0.0'):
+    """Minimal HTTP listener answering every request with the metrics, for the CLI."""
+    server = await asyncio.start_server(handle_scrape, host, port)
+    logger.info(f"Serving metrics on {host}:{port}")
+    return server
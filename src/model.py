@@ -3,16 +3,16 @@ import json
 from pydantic import BaseModel as PyDanticBaseModel
 from util import DB
 
-from c import redis_handle
+from c import async_redis_handle
 
 class BaseModel(PyDanticBaseModel):
     def to_file(self, path):
         with open(path, 'w') as f:
             json.dump(json.loads(self.json()), f)
 
-    def save(self):
-        dbo = DB(redis_handle(), model=self)
-        dbo.save()
+    async def save(self):
+        dbo = DB(await async_redis_handle(), model=self)
+        await dbo.save()
         return dbo
 
     def to_dict(self):
@@ -0,0 +1,98 @@
+from c import REDIS_ROUNDTRIP
+from log import logger
+from store import SignalStore, now_ns
+
+
+def history_key(signal):
+    return f'signal_history:{signal}'
+
+
+def encode_reading(timestamp, value):
+    return f'{int(timestamp)}:{float(value)!r}'
+
+
+def decode_reading(member):
+    timestamp, value = member.split(b':', 1)
+    return int(timestamp), float(value)
+
+
+class SignalHistory:
+    """Append-only signal history in Redis.
+
+    Each signal's readings live in a sorted set scored by timestamp (ms) so a
+    flush only sends the readings appended since the last flush and a replay
+    only reads the retained window. The retention of each signal is kept in
+    the signal_retention hash and the signal names in the signals set.
+    """
+    __shared_state = {}
+
+    def __init__(self):
+        self.__dict__ = self.__shared_state
+        try:
+            self.cursors
+        except AttributeError:
+            self.cursors = {}
+
+    async def flush(self, r, stores):
+        """Write readings appended since the last flush in a single pipeline."""
+        pipe = r.pipeline()
+        cursors = {}
+        written = 0
+        for signal, store in stores.items():
+            window = store.since(self.cursors.get(signal, 0))
+            cursors[signal] = store.seq
+            if not len(window):
+                continue
+            key = history_key(signal)
+            pairs = []
+            for timestamp, value in zip(window.timestamps, window.values):
+                pairs.extend((int(timestamp) // 1000000, encode_reading(timestamp, value)))
+            pipe.zadd(key, *pairs)
+            if store.retention is None:
+                pipe.zremrangebyrank(key, 0, -(store.capacity + 1))
+            else:
+                pipe.zremrangebyscore(
+                    key, max=(now_ns() - store.retention) // 1000000,
+                    exclude=r.ZSET_EXCLUDE_MAX,
+                )
+                pipe.hset('signal_retention', signal, store.retention)
+            pipe.sadd('signals', signal)
+            written += len(window)
+        if written:
+            with REDIS_ROUNDTRIP.time('history_flush'):
+                await pipe.execute()
+        self.cursors.update(cursors)
+        logger.debug("Flushed %s readings for %s signals", written, len(stores))
+        return written
+
+    async def replay(self, r, signals):
+        """Load the retained window of each signal into a new SignalStore."""
+        if not signals:
+            return {}
+        with REDIS_ROUNDTRIP.time('history_retention'):
+            retentions = await r.hmget('signal_retention', *signals)
+        retentions = [int(retention) if retention else None for retention in retentions]
+        now = now_ns()
+        pipe = r.pipeline()
+        for signal, retention in zip(signals, retentions):
+            if retention is None:
+                pipe.zrangebyscore(history_key(signal))
+            else:
+                pipe.zrangebyscore(
+                    history_key(signal), min=(now - retention) // 1000000,
+                    exclude=r.ZSET_EXCLUDE_MIN,
+                )
+        with REDIS_ROUNDTRIP.time('history_replay'):
+            histories = await pipe.execute()
+        stores = {}
+        for signal, retention, history in zip(signals, retentions, histories):
+            store = SignalStore(
+                capacity=max(len(history), SignalStore.default_capacity),
+                retention=retention,
+            )
+            for member in history:
+                timestamp, value = decode_reading(member)
+                store.append(value, timestamp)
+            self.cursors[signal] = store.seq
+            stores[signal] = store
+        return stores
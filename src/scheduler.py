@@ -0,0 +1,203 @@
+import asyncio
+import heapq
+import itertools
+import weakref
+import zlib
+
+from c import get_settings
+from log import logger
+import metrics
+from metrics import Counter, Gauge, Histogram
+
+SCHEDULER_LAG = Histogram('scheduler_lag_seconds', 'How late jobs were dispatched')
+SCHEDULER_STATS = {
+    'jobs': Gauge('scheduler_jobs', 'Jobs scheduled'),
+    'in_flight': Gauge('scheduler_in_flight', 'Jobs running'),
+    'ticks': Counter('scheduler_ticks_total', 'Batches of due jobs dispatched'),
+    'dispatched': Counter('scheduler_dispatched_total', 'Jobs dispatched'),
+    'overruns': Counter('scheduler_overruns_total', 'Jobs skipped as they were still running when due'),
+    'errors': Counter('scheduler_errors_total', 'Jobs that raised'),
+    'max_lag': Gauge('scheduler_max_lag_seconds', 'Latest any job was dispatched'),
+}
+
+
+class CatchUp:
+    """What to do with a job that missed one or more of its ticks."""
+    skip = 'skip'  # Run once now and resume on the job's original cadence
+    burst = 'burst'  # Run every missed tick back to back
+    delay = 'delay'  # Run once now and restart the interval from now
+    policies = (skip, burst, delay)
+
+
+class Job:
+    def __init__(self, scheduler, func, args, kwargs, interval, due, key):
+        self.scheduler = scheduler
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.due = due
+        self.key = key
+        self.running = False
+        self.cancelled = False
+
+    def __str__(self):
+        return f"<Job {self.key} every {self.interval}s>"
+
+    def cancel(self):
+        self.cancelled = True
+
+    def reschedule(self, now, catch_up):
+        if catch_up == CatchUp.burst:
+            self.due += self.interval
+        elif catch_up == CatchUp.delay:
+            self.due = now + self.interval
+        else:
+            missed = max(int((now - self.due) // self.interval), 0)
+            self.due += self.interval * (missed + 1)
+
+
+def jitter(key, interval, max_jitter=60):
+    """Stable offset in [0, min(interval, max_jitter)) seconds derived from key."""
+    window = int(min(interval, max_jitter) * 1000)
+    if window <= 0:
+        return 0
+    return zlib.crc32(key.encode('utf-8')) % window / 1000
+
+
+class Scheduler:
+    """Runs periodic jobs for one event loop from a heap ordered by due time.
+
+    A single runner coroutine sleeps until the earliest job is due then
+    dispatches every due job as a batch, at most concurrency at a time. The
+    runner waits for a free slot before starting each job's task, so a
+    backlog of due jobs waits in the heap rather than as pending tasks.
+    Jobs start at a deterministic jitter derived from their key so restarts
+    don't move them around, a job still running when it is due again is
+    skipped instead of stacking up.
+    """
+    def __init__(self, loop, concurrency=64, catch_up=CatchUp.skip):
+        if catch_up not in CatchUp.policies:
+            raise ValueError(
+                f"Unknown catch up policy {catch_up!r}, expected one of {', '.join(CatchUp.policies)}"
+            )
+        self.loop = loop
+        self.concurrency = concurrency
+        self.catch_up = catch_up
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.semaphore = None
+        self.runner = None
+        self.stats = {
+            'jobs': 0,
+            'ticks': 0,
+            'dispatched': 0,
+            'overruns': 0,
+            'errors': 0,
+            'in_flight': 0,
+            'last_batch': 0,
+            'last_lag': 0.0,
+            'max_lag': 0.0,
+        }
+
+    def schedule(self, func, args=None, kwargs=None, interval=60, key=None):
+        key = key or getattr(func, '__qualname__', None) or str(func)
+        job = Job(
+            self, func, args or [], kwargs or {}, interval,
+            due=self.loop.time() + jitter(key, interval), key=key,
+        )
+        self.push(job)
+        self.stats['jobs'] += 1
+        if self.runner is None:
+            self.runner = self.loop.create_task(self.run())
+        return job
+
+    def push(self, job):
+        heapq.heappush(self.heap, (job.due, next(self.counter), job))
+        if self.wakeup is not None and self.heap[0][2] is job:
+            self.wakeup.set()
+
+    async def sleep_until(self, due):
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout=due - self.loop.time())
+        except asyncio.TimeoutError:
+            pass
+
+    async def dispatch(self, job):
+        """Run the job, the runner acquired the semaphore for it."""
+        try:
+            await job.func(*job.args, **job.kwargs)
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.error(f"{job}: Error running scheduled job: {e}")
+        finally:
+            self.semaphore.release()
+            job.running = False
+            self.stats['in_flight'] -= 1
+
+    def pop_due(self, now):
+        batch = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, job = heapq.heappop(self.heap)
+            if job.cancelled:
+                self.stats['jobs'] -= 1
+                continue
+            batch.append(job)
+        return batch
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            if not self.heap:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            if self.heap[0][0] > self.loop.time():
+                await self.sleep_until(self.heap[0][0])
+                continue
+            now = self.loop.time()
+            batch = self.pop_due(now)
+            self.stats['ticks'] += 1
+            self.stats['last_batch'] = len(batch)
+            for job in batch:
+                if job.running:
+                    self.stats['overruns'] += 1
+                elif not job.cancelled:
+                    await self.semaphore.acquire()
+                    lag = self.loop.time() - job.due
+                    SCHEDULER_LAG.observe(lag)
+                    self.stats['last_lag'] = lag
+                    self.stats['max_lag'] = max(self.stats['max_lag'], lag)
+                    job.running = True
+                    self.stats['dispatched'] += 1
+                    self.stats['in_flight'] += 1
+                    self.loop.create_task(self.dispatch(job))
+                job.reschedule(now, self.catch_up)
+                heapq.heappush(self.heap, (job.due, next(self.counter), job))
+
+
+schedulers = weakref.WeakKeyDictionary()
+
+
+def collect_scheduler_stats():
+    for key, metric in SCHEDULER_STATS.items():
+        values = [s.stats[key] for s in schedulers.values()]
+        metric.set(max(values, default=0) if key == 'max_lag' else sum(values))
+
+
+metrics.collectors.append(collect_scheduler_stats)
+
+
+def get_scheduler(loop):
+    scheduler = schedulers.get(loop)
+    if scheduler is None:
+        settings = get_settings()
+        scheduler = schedulers[loop] = Scheduler(
+            loop,
+            concurrency=settings.scheduler_concurrency,
+            catch_up=settings.scheduler_catch_up,
+        )
+    return scheduler
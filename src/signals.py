@@ -1,21 +1,63 @@
-from datetime import datetime, timedelta
-from concurrent.futures import ALL_COMPLETED
 import functools
+import importlib
 import json
 import os
-from typing import Optional
 
-import asyncio
-import aiohttp
-import pandas as pd
-import psutil
+from log import logger
 
-from log import main as send_matrix_message, logger
-from util import Borg
+from c import get_settings
+from fetch import get_fetcher
+from host import HostMetrics
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:  # Python < 3.8, no plugin discovery
+    entry_points = None
+
+PLUGIN_GROUP = 'signal_deviation_alerts.signals'
+
+
+class LazySignal:
+    """Signal class described by its 'module:attr' path, imported when the
+    first signal is created. Keyword arguments are bound like a partial."""
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.kwargs = kwargs
+        self.factory = None
+
+    def load(self):
+        if self.factory is None:
+            module, _, attr = self.path.partition(':')
+            factory = functools.reduce(getattr, attr.split('.'), importlib.import_module(module))
+            self.factory = functools.partial(factory, **self.kwargs)
+        return self.factory
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __repr__(self):
+        return f'<LazySignal {self.path}>'
+
+
+def plugin_signals():
+    """Signals installed packages expose as PLUGIN_GROUP entry points, e.g.
+
+        [tool.poetry.plugins."signal_deviation_alerts.signals"]
+        eth_price = "my_signals:EthPrice"
+    """
+    if entry_points is None:
+        return {}
+    eps = entry_points()
+    group = eps.select(group=PLUGIN_GROUP) if hasattr(eps, 'select') else eps.get(PLUGIN_GROUP, ())
+    return {ep.name.lower(): LazySignal(ep.value) for ep in group}
 
-from c import Settings
 
 class SignalMap:
+    """Signal name -> factory called with loop to create the signal.
+
+    Builtin signals register when this module is imported, plugins are only
+    looked up the first time a name isn't a builtin or every name is listed.
+    """
     __shared_state = {}
 
     def __init__(self):
@@ -24,17 +66,24 @@ class SignalMap:
             self.value
         except AttributeError:
             self.value = {}
+            self.plugins = None
 
+    def discover(self):
+        if self.plugins is None:
+            self.plugins = plugin_signals()
+            for name, signal in self.plugins.items():
+                # Builtins win over plugins of the same name
+                self.value.setdefault(name, signal)
+        return self.value
 
-class BtcPriceCache:
-    __shared_state = {}
+    def get(self, name):
+        signal = self.value.get(name)
+        if signal is None:
+            signal = self.discover().get(name)
+        return signal
 
-    def __init__(self):
-        self.__dict__ = self.__shared_state
-        try:
-            self.value
-        except AttributeError:
-            self.value = {}
+    def names(self):
+        return list(self.discover())
 
 
 def register_signal(name):
@@ -42,143 +91,168 @@ def register_signal(name):
         signals = SignalMap()
         if not signals.value:
             signals.value = {}
-        logger.debug(f"Register signal {name}")
+        logger.debug("Register signal %s", name)
         signals.value[name] = func
-        logger.debug(f"Signals {signals.value}")
         return func
     return wrapper
 
 
 class HttpSignal:
+    """Signal read from the response to a GET of url.
+
+    Subclasses set url and parse, responses are shared with every other
+    fetch of the same url and cached for ttl seconds.
+    """
+    url = None
+    ttl = 0
+
     def __init__(self, loop):
         self.loop = loop
-        self.session = aiohttp.ClientSession(loop=loop)
 
-    async def _fetch(self, url):
-        async with self.session.get(url) as response:
-            status = response.status
-            data = await response.text()
-            if status != 200:
-                logger.warning(f"Error communicating with signal API (HTTP Code {status}): {data}")
-            assert status == 200
-            return url, data
+    def parse(self, data):
+        raise NotImplementedError
 
-    def __del__(self):
-        self.session.close()
+    async def __call__(self):
+        return self.parse(await get_fetcher(self.loop).get(self.url, ttl=self.ttl))
 
 
-class LoadAvgSignal:
+class Signal:
     def __init__(self, loop):
         self.loop = loop
-        load_avg = os.getloadavg()
-        self.load_avg_map = {
-            1: load_avg[0],
-            5: load_avg[1],
-            15: load_avg[2]
-        }
 
-    def get_average(self, timeframe):
-        return self.load_avg_map[timeframe]
 
+class HostSignal(Signal):
+    """Signal read from the host snapshot shared by every host signal polled
+    in the same tick. They share a schedule key so they jitter alike and tick
+    together."""
+    schedule_key = 'host'
+
+    def read(self, host):
+        raise NotImplementedError
+
+    async def __call__(self):
+        return self.read(HostMetrics().snapshot())
 
-class Signal:
-    def __init__(self, loop):
-        self.loop = loop
+
+class LoadAvgSignal(HostSignal):
+    timeframe = None
+
+    def read(self, host):
+        return host.load[{1: 0, 5: 1, 15: 2}[self.timeframe]]
 
 
 @register_signal('server_load_1m')
 class LoadAvgOneMinute(LoadAvgSignal):
-    async def __call__(self):
-        return self.get_average(1)
+    timeframe = 1
 
 
 @register_signal('server_load_5m')
 class LoadAvgFiveMinute(LoadAvgSignal):
-    async def __call__(self):
-        return self.get_average(5)
+    timeframe = 5
 
 
 @register_signal('server_load_15m')
 class LoadAvgFifteenMinute(LoadAvgSignal):
-    async def __call__(self):
-        return self.get_average(15)
+    timeframe = 15
 
 
 @register_signal('server_memory_usage_percentage')
-class MemoryUsagePercentage(Signal):
-    async def __call__(self):
-        return psutil.virtual_memory().percent
+class MemoryUsagePercentage(HostSignal):
+    def read(self, host):
+        return host.memory.percent
 
 
 @register_signal('server_memory_usage_used')
-class MemoryUsageUsed(Signal):
-    async def __call__(self):
-        return psutil.virtual_memory().used
+class MemoryUsageUsed(HostSignal):
+    def read(self, host):
+        return host.memory.used
 
 
 @register_signal('server_memory_usage_free')
-class MemoryUsageFree(Signal):
-    async def __call__(self):
-        return psutil.virtual_memory().free
+class MemoryUsageFree(HostSignal):
+    def read(self, host):
+        return host.memory.free
 
 
 @register_signal('server_memory_swap_usage_percentage')
-class MemorySwapUsagePercentage(Signal):
-    async def __call__(self):
-        return psutil.swap_memory().percent
+class MemorySwapUsagePercentage(HostSignal):
+    def read(self, host):
+        return host.swap.percent
 
 
 @register_signal('server_memory_swap_usage_used')
-class MemorySwapUsageUsed(Signal):
-    async def __call__(self):
-        return psutil.swap_memory().used
+class MemorySwapUsageUsed(HostSignal):
+    def read(self, host):
+        return host.swap.used
 
 
 @register_signal('server_memory_swap_usage_free')
-class MemorySwapUsageFree(Signal):
-    async def __call__(self):
-        return psutil.swap_memory().free
+class MemorySwapUsageFree(HostSignal):
+    def read(self, host):
+        return host.swap.free
 
 
-@register_signal('server_disk_usage_percent')
-class DiskUsagePercent(Signal):
+class CpuSignal(HostSignal):
+    """Host signal that needs psutil's CPU utilization primed, see HostMetrics."""
+    def __init__(self, loop):
+        super().__init__(loop)
+        HostMetrics().prime_cpu()
+
     async def __call__(self):
-        return psutil.disk_usage('/').percent
+        await HostMetrics().cpu_ready()
+        return await super().__call__()
 
 
-@register_signal('server_disk_usage_free')
-class DiskUsageFree(Signal):
-    async def __call__(self):
-        return psutil.disk_usage('/').free
+@register_signal('server_cpu_usage_percent')
+class CpuUsagePercent(CpuSignal):
+    def read(self, host):
+        return host.cpu
 
 
-@register_signal('server_disk_usage_used')
-class DiskyUsageUsed(Signal):
-    async def __call__(self):
-        return psutil.disk_usage('/').used
+class CpuCoreUsagePercent(CpuSignal):
+    def __init__(self, loop, cpu):
+        super().__init__(loop)
+        self.cpu = cpu
+
+    def read(self, host):
+        return host.cpus[self.cpu]
+
+
+class DiskUsage(HostSignal):
+    def __init__(self, loop, mount, field):
+        super().__init__(loop)
+        self.mount = mount
+        self.field = field
+
+    def read(self, host):
+        return getattr(host.disk(self.mount), self.field)
+
+
+def register_host_signals(mounts):
+    """Per CPU signals and disk usage signals for each mount, / keeps the
+    unsuffixed server_disk_usage_* names."""
+    for cpu in range(os.cpu_count() or 0):
+        register_signal(f'server_cpu{cpu}_usage_percent')(
+            functools.partial(CpuCoreUsagePercent, cpu=cpu),
+        )
+    for mount in mounts:
+        suffix = '' if mount == '/' else '_' + mount.strip('/').replace('/', '_')
+        for field in ('percent', 'free', 'used'):
+            register_signal(f'server_disk_usage_{field}{suffix}')(
+                functools.partial(DiskUsage, mount=mount, field=field),
+            )
+
+
+register_host_signals(get_settings().host_disk_mounts)
 
 
 @register_signal('btc_price')
 class BTCPrice(HttpSignal):
-    async def __call__(self):
-        price_cache = BtcPriceCache()
-        if price_cache.value:
-            logger.debug(f"Cached BTC value {price_cache.value}")
-            if (datetime.utcnow() - price_cache.value['timestamp']).total_seconds() < 60:
-                logger.debug(f"Returning cached BTC price ({price_cache.value['value']}) from {price_cache.value['timestamp']}")
-                return price_cache.value['value']
-        logger.debug("Fetching price of BTC")
-        tasks = [self._fetch('https://blockchain.info/ticker')]
-        done, pending = await asyncio.wait(
-            tasks,
-            loop=self.loop,
-            return_when=ALL_COMPLETED
-        )
-        for task in done:
-            url, data = task.result()
-            btc_price = json.loads(data)['USD']['last']
-        price_cache.value = {'timestamp': datetime.utcnow(), 'value': btc_price}
-        return btc_price
+    url = 'https://blockchain.info/ticker'
+    ttl = 60
+
+    def parse(self, data):
+        return json.loads(data)['USD']['last']
 
     def __str__(self):
         return "<Signal btc_price>"
@@ -186,28 +260,19 @@ class BTCPrice(HttpSignal):
 
 @register_signal('btc_stock_to_flow')
 class GlassnodeStockToFlowDeflection(HttpSignal):
+    ttl = 60
+
     def __str__(self):
         return "<Signal btc_stock_to_flow>"
 
-    async def __call__(self):
-        config = Settings()
-        logger.debug("Fetching the stock to flow deflection")
-        tasks = [self._fetch(
-            'https://api.glassnode.com'\
-                f'/v1/metrics/indicators/stock_to_flow_deflection'\
-                f'?a=BTC&api_key={config.glassnode_api_key}'
-        )]
-        done, pending = await asyncio.wait(
-            tasks,
-            loop=self.loop,
-            return_when=ALL_COMPLETED
-        )
-        for task in done:
-            url, data = task.result()
-            data = json.loads(data)
-        df = pd.DataFrame(data)
+    @property
+    def url(self):
+        return 'https://api.glassnode.com'\
+            '/v1/metrics/indicators/stock_to_flow_deflection'\
+            f'?a=BTC&api_key={get_settings().glassnode_api_key}'
+
+    def parse(self, data):
+        import pandas as pd
+        df = pd.DataFrame(json.loads(data))
         df.loc[:, 't'] = pd.to_datetime(df['t'], unit='s')
         return float(df.set_index('t').last('1H')['v'])
-
-
-EOF = None # Force python to read the whole file
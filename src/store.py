@@ -0,0 +1,203 @@
+import collections
+import math
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+
+class SignalWindow(NamedTuple):
+    timestamps: np.ndarray
+    values: np.ndarray
+
+    def __len__(self):
+        return len(self.values)
+
+
+def now_ns():
+    return time.time_ns()
+
+
+def timedelta_ns(td):
+    return int(td.total_seconds() * 1e9)
+
+
+class SignalStore:
+    """Ring buffer of (timestamp ns, value) readings for a single signal.
+
+    Every reading is written twice, at its slot and at slot + capacity, so
+    the live readings are always one contiguous slice of the backing arrays
+    and windows can be handed out as views without copying.
+
+    When a retention (in ns) is set the buffer drops readings older than the
+    retention and grows instead of overwriting readings still inside it.
+    Without a retention the oldest reading is overwritten once full.
+    """
+    default_capacity = 1024
+
+    def __init__(self, capacity=None, retention=None):
+        self.capacity = max(int(capacity or self.default_capacity), 1)
+        self.retention = retention
+        self._ts = np.empty(self.capacity * 2, dtype=np.int64)
+        self._values = np.empty(self.capacity * 2, dtype=np.float64)
+        self._start = 0
+        self._size = 0
+        self.seq = 0  # Total readings ever appended
+        self.evaluators = {}
+
+    def __len__(self):
+        return self._size
+
+    def __repr__(self):
+        return f"<SignalStore size={self._size} capacity={self.capacity} retention={self.retention}>"
+
+    @property
+    def timestamps(self):
+        return self._ts[self._start:self._start + self._size]
+
+    @property
+    def values(self):
+        return self._values[self._start:self._start + self._size]
+
+    @property
+    def head(self):
+        """Sequence number of the oldest reading still held."""
+        return self.seq - self._size
+
+    def evaluator(self, cls, duration):
+        """Shared incremental evaluator of cls over the last duration ns."""
+        key = (cls, duration)
+        evaluator = self.evaluators.get(key)
+        if evaluator is None:
+            evaluator = self.evaluators[key] = cls(self, duration)
+        return evaluator
+
+    def reserve(self, capacity=None, retention=None):
+        """Widen the store so it can hold at least capacity readings and retention ns."""
+        if retention is not None and (self.retention is None or retention > self.retention):
+            self.retention = retention
+        if capacity is not None and capacity > self.capacity:
+            self._resize(capacity)
+
+    def _resize(self, capacity):
+        ts, values = self.timestamps.copy(), self.values.copy()
+        self.capacity = capacity
+        self._ts = np.empty(capacity * 2, dtype=np.int64)
+        self._values = np.empty(capacity * 2, dtype=np.float64)
+        self._start = 0
+        size = len(ts)
+        self._ts[:size] = self._ts[capacity:capacity + size] = ts
+        self._values[:size] = self._values[capacity:capacity + size] = values
+
+    def _drop_oldest(self):
+        self._start = (self._start + 1) % self.capacity
+        self._size -= 1
+
+    def expire(self, timestamp=None):
+        """Drop readings that fell out of the retention."""
+        if self.retention is None or not self._size:
+            return
+        cutoff = (timestamp or now_ns()) - self.retention
+        while self._size and self._ts[self._start] < cutoff:
+            self._drop_oldest()
+
+    def append(self, value, timestamp=None):
+        timestamp = timestamp or now_ns()
+        self.expire(timestamp)
+        if self._size == self.capacity:
+            if self.retention is None:
+                self._drop_oldest()
+            else:
+                self._resize(self.capacity * 2)
+        pos = (self._start + self._size) % self.capacity
+        self._ts[pos] = self._ts[pos + self.capacity] = timestamp
+        self._values[pos] = self._values[pos + self.capacity] = value
+        self._size += 1
+        self.seq += 1
+        for evaluator in self.evaluators.values():
+            evaluator.push(timestamp, value)
+        return self
+
+    def _write(self, pos, timestamps, values):
+        end = pos + len(values)
+        self._ts[pos:end] = self._ts[pos + self.capacity:end + self.capacity] = timestamps
+        self._values[pos:end] = self._values[pos + self.capacity:end + self.capacity] = values
+
+    def extend(self, values, timestamps):
+        """Append many readings at once, timestamps (ns) must be sorted."""
+        values = np.asarray(values, dtype=np.float64)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if not len(values):
+            return self
+        if self.evaluators:
+            for timestamp, value in zip(timestamps, values):
+                self.append(value, int(timestamp))
+            return self
+        appended = len(values)
+        newest = int(timestamps[-1])
+        self.expire(newest)
+        if self.retention is not None:
+            keep = timestamps >= newest - self.retention
+            timestamps, values = timestamps[keep], values[keep]
+            if self._size + len(values) > self.capacity:
+                self._resize(2 ** math.ceil(math.log2(self._size + len(values))))
+        else:
+            timestamps, values = timestamps[-self.capacity:], values[-self.capacity:]
+            overflow = self._size + len(values) - self.capacity
+            if overflow > 0:
+                self._start = (self._start + overflow) % self.capacity
+                self._size -= overflow
+        pos = (self._start + self._size) % self.capacity
+        split = min(len(values), self.capacity - pos)
+        self._write(pos, timestamps[:split], values[:split])
+        self._write(0, timestamps[split:], values[split:])
+        self._size += len(values)
+        self.seq += appended
+        return self
+
+    def since(self, seq):
+        """View of the readings with sequence number seq or later."""
+        i = min(max(seq - self.head, 0), self._size)
+        return SignalWindow(self.timestamps[i:], self.values[i:])
+
+
+class MinMaxEvaluator:
+    """Tracks (min, max) over the readings of a store within duration ns of now
+    with monotonic deques of (timestamp, value).
+
+    Evaluators are fed on append and expire lazily on read, so each reading
+    is added and removed once: amortized O(1) per tick regardless of window size.
+    """
+    def __init__(self, store, duration):
+        self.store = store
+        self.duration = duration
+        self.mins = collections.deque()
+        self.maxes = collections.deque()
+        for timestamp, value in zip(store.timestamps, store.values):
+            self.push(timestamp, value)
+
+    def push(self, timestamp, value):
+        while self.mins and self.mins[-1][1] >= value:
+            self.mins.pop()
+        self.mins.append((timestamp, value))
+        while self.maxes and self.maxes[-1][1] <= value:
+            self.maxes.pop()
+        self.maxes.append((timestamp, value))
+
+    def expire(self, cutoff):
+        while self.mins and self.mins[0][0] <= cutoff:
+            self.mins.popleft()
+        while self.maxes and self.maxes[0][0] <= cutoff:
+            self.maxes.popleft()
+
+    def read(self, timestamp=None):
+        """(min, max) of the current window or None when it is empty."""
+        self.expire((timestamp or now_ns()) - self.duration)
+        if not self.mins:
+            return None
+        return float(self.mins[0][1]), float(self.maxes[0][1])
+
+
+def capacity_for(timeframe, poll_rate):
+    """Readings needed to cover timeframe (timedelta) when sampled every poll_rate seconds."""
+    return math.ceil(timeframe.total_seconds() / max(poll_rate, 1)) + 1
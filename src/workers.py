@@ -0,0 +1,102 @@
+import asyncio
+import multiprocessing
+import queue
+import time
+import zlib
+
+from log import logger
+
+
+def shard_for(key, shards):
+    """Stable shard of key, the same in every process and across restarts."""
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+
+class Supervisor:
+    """Keeps one worker process per shard running, restarting any that exit.
+
+    target is called as target(shard, shards, results, *args) in a fresh
+    spawned interpreter. Workers report back by putting items on results,
+    which on_result is called with in the supervisor's event loop, without
+    waiting for earlier calls to finish.
+    """
+    check_interval = 1
+    max_backoff = 60
+
+    def __init__(self, target, args, shards, workers, on_result):
+        self.context = multiprocessing.get_context('spawn')
+        self.target = target
+        self.args = args
+        self.shards = shards
+        self.workers = workers
+        self.on_result = on_result
+        self.results = self.context.Queue()
+        self.processes = {}
+        self.restarts = {}
+        self.started = {}
+        self.stopping = False
+        self.handling = set()  # on_result calls still running
+
+    def start(self, shard):
+        process = self.context.Process(
+            target=self.target,
+            args=(shard, self.workers, self.results, *self.args),
+            name=f'worker-{shard}',
+            daemon=True,
+        )
+        process.start()
+        logger.debug(f"Started worker {shard} (pid {process.pid})")
+        self.processes[shard] = process
+        self.started[shard] = time.monotonic()
+
+    async def restart(self, shard):
+        restarts = self.restarts.get(shard, 0)
+        if time.monotonic() - self.started[shard] > self.max_backoff:
+            restarts = 0  # It ran fine for a while, don't hold an old crash against it
+        backoff = min(2 ** restarts, self.max_backoff)
+        logger.warning(f"Worker {shard} exited with {self.processes[shard].exitcode}, restarting in {backoff}s")
+        self.restarts[shard] = restarts + 1
+        await asyncio.sleep(backoff)
+        if not self.stopping:
+            self.start(shard)
+
+    async def supervise(self):
+        for shard in self.shards:
+            self.start(shard)
+        restarting = set()
+        while not self.stopping:
+            for shard, process in self.processes.items():
+                if not process.is_alive() and shard not in restarting:
+                    restarting.add(shard)
+                    task = asyncio.ensure_future(self.restart(shard))
+                    task.add_done_callback(lambda _, shard=shard: restarting.discard(shard))
+            await asyncio.sleep(self.check_interval)
+
+    async def collect(self):
+        loop = asyncio.get_event_loop()
+        while not self.stopping:
+            try:
+                result = await loop.run_in_executor(
+                    None, self.results.get, True, self.check_interval,
+                )
+            except queue.Empty:
+                continue
+            # Handled concurrently so results arriving together, e.g. the
+            # alerts of one tick, can be merged into one digest
+            task = asyncio.ensure_future(self.handle(result))
+            self.handling.add(task)
+            task.add_done_callback(self.handling.discard)
+
+    async def handle(self, result):
+        try:
+            await self.on_result(result)
+        except Exception as e:
+            logger.error(f"Error handling worker result: {e}")
+
+    def stop(self):
+        self.stopping = True
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=10)